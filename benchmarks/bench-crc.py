@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# Compare the table driven CRCs in w1crc with the bit by bit implementation
+# W1ftdi.crc() used to have. No FT232H is needed.
+
+import sys
+import time
+import random
+sys.path.append("..")
+
+from w1crc import crc8, crc16, verify_many, Crc
+
+runs = 2000
+
+# The original bit by bit CRC
+def bitwise(data, bits=8):
+    if bits == 8:
+        poly = 0x8c
+    else:
+        poly = 0xa001
+    crc = 0x00
+    for byte in data:
+        for bit in range(8):
+            if ( byte ^ crc) & 0x01:
+                crc >>= 1
+                crc ^= poly
+            else:
+                crc >>= 1
+            byte >>= 1
+    return crc
+
+def timed(name, size, func):
+    start = time.clock()
+    for i in xrange(runs):
+        func()
+    elapsed = time.clock() - start
+    print "{:32}: {:8.3f} us/call {:8.3f} us/byte".format(name, elapsed * 1000000.0 / runs,
+                                                         elapsed * 1000000.0 / (runs * size))
+
+# A DS18B20 scratchpad and a DS1977 page, each followed by its CRC
+scratchpad = bytearray(random.getrandbits(8) for i in range(8))
+scratchpad.append(crc8(scratchpad))
+page = bytearray((0x69, 0x00, 0x00)) + bytearray(random.getrandbits(8) for i in range(64))
+crc = crc16(page)
+page.extend((crc & 0xff, crc >> 8))
+assert bitwise(scratchpad) == crc8(scratchpad) == 0
+assert bitwise(page, 16) == crc16(page) == 0
+
+timed("bitwise crc8 scratchpad", len(scratchpad), lambda: bitwise(scratchpad))
+timed("table crc8 scratchpad", len(scratchpad), lambda: crc8(scratchpad))
+timed("bitwise crc16 page", len(page), lambda: bitwise(page, 16))
+timed("table crc16 page", len(page), lambda: crc16(page))
+timed("incremental crc16 page", len(page), lambda: Crc(16).update(page[:32]).update(page[32:]).valid())
+
+scratchpads = [ scratchpad ] * 100
+start = time.clock()
+for i in xrange(runs // 100):
+    [ bitwise(s) == 0 for s in scratchpads ]
+bitwise_many = time.clock() - start
+start = time.clock()
+for i in xrange(runs // 100):
+    verify_many(scratchpads)
+table_many = time.clock() - start
+print "{:32}: {:8.3f} us/buffer".format("bitwise verify 100 scratchpads", bitwise_many * 1000000.0 / runs)
+print "{:32}: {:8.3f} us/buffer".format("verify_many 100 scratchpads", table_many * 1000000.0 / runs)
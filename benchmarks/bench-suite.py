@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# Benchmark suite, run against the simulated FT232H and slaves in ftdisim.py
+# so no hardware is needed. Measures the USB traffic and CPU time of the
+# 1-wire operations, and writes the results as JSON to compare between
+# commits:
+#
+#   ./bench-suite.py -o before.json
+#   ./bench-suite.py -o after.json --compare before.json
+#
+# Bus time is simulated, so sleeps cost nothing. cpu_us is the host CPU used
+# by w1ftdi, with the time spent emulating the FT232H taken away.
+
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+sys.path.append("..")
+
+import ftdisim
+sys.modules["ftdi1"] = ftdisim
+ftdisim.virtual_sleep()
+
+from w1ftdi import W1ftdi
+from ds18b20 import Ds18b20
+from ds1977 import Ds1977
+
+# There are no kernel modules to remove on a simulated FT232H
+W1ftdi._rmmod = lambda self: None
+
+COUNTERS = ("writes", "reads", "empty_reads", "bytes_written", "bytes_read", "stalls")
+SEARCH_DEVICES = (1, 2, 5, 10, 20, 50)
+
+# A W1ftdi on a fresh simulated bus, with devices attached to pin 8
+def open_bus(devices=(), cls=W1ftdi, **kwargs):
+    ftdisim.reset_all()
+    for device in devices:
+        ftdisim.attach(8, device)
+    w1 = cls(8, 0, **kwargs)
+    if cls is W1ftdi:
+        w1.open()
+        w1.sync()
+        w1.setup_clock()
+    return w1
+
+# Run func runs times, returns the cost per run, and per byte if size (the
+# bytes handled per run) is given.
+def measure(w1, func, runs=1, size=None):
+    before = ftdisim.stats()
+    trips = w1.round_trips
+    sim = ftdisim.sim_time()
+    start = time.clock()
+    for i in xrange(runs):
+        func()
+    cpu = time.clock() - start
+    after = ftdisim.stats()
+    cpu -= after.get("emulator_seconds", 0) - before.get("emulator_seconds", 0)
+    result = {
+        "cpu_us": cpu * 1000000.0 / runs,
+        "sim_ms": (ftdisim.sim_time() - sim) * 1000.0 / runs,
+        "round_trips": float(w1.round_trips - trips) / runs,
+    }
+    for key in COUNTERS:
+        result[key] = float(after.get(key, 0) - before.get(key, 0)) / runs
+    if size:
+        result["cpu_us_per_byte"] = result["cpu_us"] / size
+        result["usb_bytes_per_byte"] = (result["bytes_written"] + result["bytes_read"]) / size
+    return result
+
+# Write count bytes one at a time into a single command buffer
+def buffered_writes(w1, count):
+    with w1.command_buffer():
+        for i in xrange(count):
+            w1.write_byte(i)
+
+def bench_write(results):
+    w1 = open_bus()
+    results["write_byte"] = measure(w1, lambda: w1.write_byte(0xa5), 2000, 1)
+    data = bytearray(range(64))
+    results["write_bytes_64"] = measure(w1, lambda: w1.write_bytes(data), 200, 64)
+    results["buffered_write_byte_4096"] = measure(w1, lambda: buffered_writes(w1, 4096), 5, 4096)
+    w1.close()
+
+def bench_read(results):
+    w1 = open_bus()
+    results["read_byte"] = measure(w1, lambda: w1.read_byte(), 500, 1)
+    results["read_bytes_64"] = measure(w1, lambda: w1.read_bytes(64), 50, 64)
+    results["read_bytes_256"] = measure(w1, lambda: w1.read_bytes(256), 10, 256)
+    w1.close()
+
+def bench_search(results):
+    for count in SEARCH_DEVICES:
+        w1 = open_bus([ ftdisim.DS18B20(i + 1) for i in range(count) ])
+        found = []
+        result = measure(w1, lambda: found.extend(w1.search_roms()))
+        if len(found) != count:
+            raise Exception("Search found {} of {} devices".format(len(found), count))
+        result["per_device"] = dict((key, value / count) for key, value in result.items())
+        results["search_roms_{}".format(count)] = result
+        w1.close()
+
+def bench_ds18b20(results):
+    sensors = [ ftdisim.DS18B20(i + 1) for i in range(10) ]
+    ds = open_bus(sensors, Ds18b20)
+    roms = ds.search_roms(family=Ds18b20.FAMILY)
+    results["ds18b20_get_temps_10"] = measure(ds, lambda: ds.get_temps(roms), 5)
+    ds.close()
+
+def bench_ds1977(results):
+    button = ftdisim.DS1977(1)
+    ds = open_bus([ button ], Ds1977, rom=button.rom_string())
+    pages = 16
+    result = measure(ds, lambda: ds.read_pages(0, "password", pages), 2, pages * 64)
+    result["bytes_per_sim_second"] = pages * 64 * 1000.0 / result["sim_ms"]
+    results["ds1977_read_memory_{}".format(pages)] = result
+    buffer = bytearray(ds._pages * 64)
+    result = measure(ds, lambda: [ page for page in ds.dump("password", buffer=buffer) ], 1, len(buffer))
+    result["bytes_per_sim_second"] = len(buffer) * 1000.0 / result["sim_ms"]
+    results["ds1977_dump"] = result
+    data = bytearray(range(256)) * 4
+    results["ds1977_write_memory_16"] = measure(ds, lambda: ds.write_memory(0, data, "password"), 2, len(data))
+    results["ds1977_write_memory_differential_16"] = measure(
+        ds, lambda: ds.write_memory(0, data, "password", differential=True), 2, len(data))
+    memory = ds.memory("password")
+    record = bytearray(1024)
+    def readinto():
+        memory.seek(100)
+        memory.readinto(record)
+    results["ds1977_file_readinto_1024"] = measure(ds, readinto, 2, len(record))
+    ds.enable_cache()
+    ds.read_pages(0, "password", 4)
+    results["ds1977_cached_read_pages_4"] = measure(ds, lambda: ds.read_pages(0, "password", 4), 100, 4 * 64)
+    ds.disable_cache()
+    ds.close()
+
+BENCHMARKS = [ bench_write, bench_read, bench_search, bench_ds18b20, bench_ds1977 ]
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.STDOUT).strip()
+    except Exception:
+        return None
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def report(results, baseline=None):
+    flat = flatten(results)
+    old = flatten(baseline) if baseline else {}
+    for key in sorted(flat):
+        line = "{:48}: {:12.3f}".format(key, flat[key])
+        if key in old:
+            change = ""
+            if old[key]:
+                change = "{:+8.1f}%".format((flat[key] - old[key]) * 100.0 / old[key])
+            line += " was {:12.3f} {}".format(old[key], change)
+        print line
+
+def main():
+    parser = argparse.ArgumentParser(description="1-wire benchmarks on a simulated FT232H")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("-c", "--compare", help="compare with the results in this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for bench in BENCHMARKS:
+        bench(results)
+    output = {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# CPU time per byte spent building the MPSSE commands for write_byte(). The
+# commands are buffered and thrown away, so no FT232H needs to be attached,
+# only the ftdi1 module installed.
+#
+# "bit by bit" is how write_byte() used to work, calling write_bit() for every
+# bit, "table" is write_byte() and "bulk" is write_bytes().
+
+import sys
+import time
+sys.path.append("..")
+
+from w1ftdi import W1ftdi
+
+pin   = 8       # pin c0
+count = 20000   # bytes to write per run
+
+def bit_by_bit(w1, data):
+    for byte in data:
+        del w1._output[:]
+        for i in range(8):
+            w1.write_bit(byte & 1)
+            byte >>= 1
+
+def table(w1, data):
+    for byte in data:
+        del w1._output[:]
+        w1.write_byte(byte)
+
+def bulk(w1, data):
+    del w1._output[:]
+    w1.write_bytes(data)
+
+w1 = W1ftdi(pin, 0, overdrive=True)
+data = bytearray(i & 0xff for i in range(count))
+w1.enable_command_buffer()
+for overdrive in (False, True):
+    w1._reset_clocks(overdrive)
+    for name, func in (("bit by bit", bit_by_bit), ("table", table), ("bulk", bulk)):
+        start = time.clock()
+        func(w1, data)
+        elapsed = time.clock() - start
+        print "Overdrive: {!s:5} {:10}: {:8.3f} us/byte".format(overdrive, name, elapsed * 1000000.0 / count)
+w1.discard_command_buffer()
+w1.close()
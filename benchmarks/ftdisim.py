@@ -0,0 +1,713 @@
+#!/usr/bin/python
+
+# Software stand-in for the ftdi1 (libftdi1) python bindings.
+#
+# Emulates the parts of the FT232H MPSSE which w1ftdi uses, and a 1-Wire bus
+# with simulated DS18B20 and DS1977 slaves hanging off any GPIO pin. Time on
+# the bus is virtual: it advances with MPSSE clock commands, and with host
+# sleeps (real ones by default, or virtual ones after virtual_sleep()).
+#
+# Usage: import ftdisim; sys.modules["ftdi1"] = ftdisim; ftdisim.attach(8, dev)
+#
+# https://www.ftdichip.com/Support/Documents/AppNotes/AN_108_Command_Processor_for_MPSSE_and_MCU_Host_Bus_Emulation_Modes.pdf
+
+import time
+import types
+import threading
+
+RX_FIFO = 1024        # FT232H receive FIFO (bytes to host)
+BASE_CLOCK = 30000000.0
+
+# Each adapter has its own bus clock, advanced by MPSSE clock commands. Host
+# time (wall clock, or virtual sleeps) is added to it. All MPSSE processing
+# happens under _lock, with _active set to the context doing the work.
+_lock = threading.RLock()
+_clock = { "slept": 0.0, "start": time.time(), "virtual": False }
+_active = [ None ]
+_real_sleep = time.sleep
+_real_time = time.time
+
+def now():
+    ctx = _active[0]
+    if ctx is None:
+        return _clock["slept"]
+    return ctx.now()
+
+def _sleep(secs):
+    with _lock:
+        _clock["slept"] += secs
+
+# Host time when sleeps are virtual, it only moves on with them
+def _time():
+    return _clock["start"] + _clock["slept"]
+
+# Replace time.sleep with one which only advances the bus clock, and
+# time.time with one which only moves on with the sleeps, so the host sees
+# the same time as the bus.
+def virtual_sleep(enable=True):
+    _clock["virtual"] = enable
+    if enable:
+        time.sleep = _sleep
+        time.time = _time
+    else:
+        time.sleep = _real_sleep
+        time.time = _real_time
+
+# crc helpers for the slaves
+def crc8(data):
+    crc = 0
+    for byte in data:
+        for i in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0x8c
+            byte >>= 1
+    return crc
+
+def crc16(data, crc=0):
+    for byte in data:
+        for i in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0xa001
+            byte >>= 1
+    return crc
+
+# Slave operations, receive a bit, or transmit one
+RX = ("rx", None)
+
+def TX(bit):
+    return ("tx", bit)
+
+class Result(Exception):
+    def __init__(self, value):
+        self.value = value
+
+def rx_byte():
+    byte = 0
+    for i in range(8):
+        bit = yield RX
+        byte |= bit << i
+    raise Result(byte)
+
+def rx_bytes(count):
+    data = bytearray()
+    for i in range(count):
+        byte = yield rx_byte()
+        data.append(byte)
+    raise Result(data)
+
+def tx_byte(byte):
+    for i in range(8):
+        yield TX((byte >> i) & 1)
+
+def tx_bytes(data):
+    for byte in data:
+        yield tx_byte(byte)
+
+def idle():
+    while True:
+        yield None
+
+class Slave(object):
+
+    family = 0x00
+    overdrive_capable = False
+
+    def __init__(self, serial):
+        rom = bytearray((self.family,))
+        for i in range(6):
+            rom.append((serial >> (8*i)) & 0xff)
+        rom.append(crc8(rom))
+        self.rom = rom
+        self.overdrive = False
+        self.resume = False
+        self._stack = []
+        self.op = None
+
+    def rom_string(self):
+        return ":".join("{:02x}".format(c) for c in self.rom)
+
+    # The bus was held low for secs, returns the presence pulse if reset.
+    def slot(self, secs, bit_hint=None):
+        if secs >= 0.000400:
+            self.overdrive = False
+            return self._reset()
+        if self.overdrive and secs >= 0.000040:
+            return self._reset()
+        if self.op is None:
+            return None
+        threshold = 0.000002 if self.overdrive else 0.000015
+        bit = 1 if secs < threshold else 0
+        kind = self.op[0]
+        if kind == "rx":
+            self._advance(bit)
+        else:
+            self._advance(None)
+        return None
+
+    # Hold time when transmitting a zero
+    def hold(self):
+        return 0.000003 if self.overdrive else 0.000030
+
+    def _reset(self):
+        self._stack = [self._rom_layer()]
+        self._advance(None)
+        if self.overdrive:
+            return (0.000002, 0.000010)
+        return (0.000015, 0.000135)
+
+    def _advance(self, value):
+        while self._stack:
+            try:
+                op = self._stack[-1].send(value)
+            except StopIteration:
+                self._stack.pop()
+                value = None
+                continue
+            except Result as r:
+                self._stack.pop()
+                value = r.value
+                continue
+            if isinstance(op, types.GeneratorType):
+                self._stack.append(op)
+                value = None
+                continue
+            self.op = op
+            return
+        self.op = None
+
+    def _rom_layer(self):
+        cmd = yield rx_byte()
+        if cmd == 0x33:
+            yield tx_bytes(self.rom)
+            self.resume = True
+        elif cmd in (0x55, 0x69):
+            if cmd == 0x69:
+                if not self.overdrive_capable:
+                    return
+                self.overdrive = True
+            rom = yield rx_bytes(8)
+            if rom != self.rom:
+                self.resume = False
+                return
+            self.resume = True
+        elif cmd == 0xcc:
+            self.resume = False
+        elif cmd == 0x3c:
+            if not self.overdrive_capable:
+                return
+            self.overdrive = True
+            self.resume = False
+        elif cmd == 0xa5:
+            if not self.resume:
+                return
+        elif cmd == 0xf0:
+            for i in range(64):
+                bit = (self.rom[i >> 3] >> (i & 7)) & 1
+                yield TX(bit)
+                yield TX(bit ^ 1)
+                direction = yield RX
+                if direction != bit:
+                    self.resume = False
+                    return
+            self.resume = True
+            return
+        else:
+            return
+        yield self._function()
+
+    def _function(self):
+        yield idle()
+
+class DS18B20(Slave):
+
+    family = 0x28
+
+    def __init__(self, serial, temperature=21.5, parasite=False):
+        super(DS18B20, self).__init__(serial)
+        self.temperature = temperature
+        self.parasite = parasite
+        self.th = 0x4b
+        self.tl = 0x46
+        self.config = 0x7f
+        self.eeprom = (0x4b, 0x46, 0x7f)
+        self.register = 0x0550
+        self._busy_until = 0.0
+        self.conversions = 0
+
+    def resolution(self):
+        return (self.config >> 5) & 0b11
+
+    def conversion_time(self):
+        return 0.09375 * (1 << self.resolution())
+
+    def _update(self):
+        if self._busy_until and now() >= self._busy_until:
+            raw = int(round(self.temperature * 16))
+            raw &= ~((1 << (3 - self.resolution())) - 1)
+            self.register = raw & 0xffff
+            self._busy_until = 0.0
+
+    def scratchpad(self):
+        self._update()
+        data = bytearray((self.register & 0xff, self.register >> 8,
+                          self.th, self.tl, self.config, 0xff, 0x0c, 0x10))
+        data.append(crc8(data))
+        return data
+
+    def _busy_bit(self):
+        return lambda: 0 if now() < self._busy_until else 1
+
+    def _function(self):
+        cmd = yield rx_byte()
+        if cmd == 0x44:
+            self._update()
+            self.conversions += 1
+            self._busy_until = now() + self.conversion_time()
+            while True:
+                yield TX(self._busy_bit())
+        elif cmd == 0xbe:
+            yield tx_bytes(self.scratchpad())
+        elif cmd == 0x4e:
+            data = yield rx_bytes(3)
+            self.th, self.tl = data[0], data[1]
+            self.config = (data[2] & 0x60) | 0x1f
+        elif cmd == 0x48:
+            self.eeprom = (self.th, self.tl, self.config)
+            self._busy_until = 0.0
+            while True:
+                yield TX(1)
+        elif cmd == 0xb8:
+            self.th, self.tl, self.config = self.eeprom
+            while True:
+                yield TX(1)
+        elif cmd == 0xb4:
+            while True:
+                yield TX(0 if self.parasite else 1)
+        yield idle()
+
+class DS1977(Slave):
+
+    family = 0x37
+    overdrive_capable = True
+
+    def __init__(self, serial, version=1):
+        super(DS1977, self).__init__(serial)
+        self.memory = bytearray(b"\xff" * 0x8000)
+        self.version = version
+        self.scratch = bytearray(64)
+        self.ta = 0
+        self.es = 0
+        self._busy_until = 0.0
+        self.copies = 0
+
+    def _passwords_enabled(self):
+        return self.memory[0x7fd0] == 0xaa
+
+    def _read_ok(self, pw):
+        if not self._passwords_enabled():
+            return True
+        return pw == self.memory[0x7fc0:0x7fc8] or pw == self.memory[0x7fc8:0x7fd0]
+
+    def _full_ok(self, pw):
+        if not self._passwords_enabled():
+            return True
+        return pw == self.memory[0x7fc8:0x7fd0]
+
+    def _data_bit(self, bit):
+        return lambda: 1 if now() < self._busy_until else bit
+
+    def _tx_after_busy(self, data):
+        for byte in data:
+            for i in range(8):
+                yield TX(self._data_bit((byte >> i) & 1))
+
+    def _aa(self):
+        while True:
+            yield self._tx_after_busy(bytearray((0xaa,)))
+
+    def _function(self):
+        cmd = yield rx_byte()
+        if cmd == 0x0f:
+            ta1 = yield rx_byte()
+            ta2 = yield rx_byte()
+            self.ta = (ta2 << 8) | ta1
+            offset = ta1 & 0x3f
+            written = bytearray()
+            for i in range(offset, 64):
+                byte = yield rx_byte()
+                self.scratch[i] = byte
+                self.es = i
+                written.append(byte)
+            crc = crc16(bytearray((0x0f, ta1, ta2)) + written)
+            yield tx_bytes(bytearray((~crc & 0xff, (~crc >> 8) & 0xff)))
+        elif cmd == 0xaa:
+            ta1 = self.ta & 0xff
+            ta2 = self.ta >> 8
+            data = bytearray((ta1, ta2, self.es))
+            data.extend(self.scratch[ta1 & 0x3f:self.es + 1])
+            yield tx_bytes(data)
+            crc = crc16(bytearray((0xaa,)) + data)
+            yield tx_bytes(bytearray((~crc & 0xff, (~crc >> 8) & 0xff)))
+        elif cmd == 0x99:
+            auth = yield rx_bytes(3)
+            pw = yield rx_bytes(8)
+            if (auth[1] << 8 | auth[0]) != self.ta or auth[2] != self.es:
+                yield idle()
+            if not self._full_ok(pw):
+                yield idle()
+            start = self.ta & ~0x3f
+            offset = self.ta & 0x3f
+            self.memory[start + offset:start + self.es + 1] = self.scratch[offset:self.es + 1]
+            self.copies += 1
+            self._busy_until = now() + 0.010
+            yield self._aa()
+        elif cmd == 0x69:
+            ta1 = yield rx_byte()
+            ta2 = yield rx_byte()
+            pw = yield rx_bytes(8)
+            if not self._read_ok(pw):
+                yield idle()
+            address = (ta2 << 8) | ta1
+            first = True
+            while address < 0x8000:
+                self._busy_until = now() + 0.005
+                end = (address | 0x3f) + 1
+                data = self.memory[address:end]
+                if first:
+                    crc = crc16(bytearray((0x69, ta1, ta2)) + data)
+                    first = False
+                else:
+                    crc = crc16(data)
+                yield self._tx_after_busy(data)
+                yield tx_bytes(bytearray((~crc & 0xff, (~crc >> 8) & 0xff)))
+                address = end
+        elif cmd == 0xc3:
+            ta1 = yield rx_byte()
+            ta2 = yield rx_byte()
+            pw = yield rx_bytes(8)
+            address = (ta2 << 8) | ta1
+            if pw != self.memory[address:address + 8]:
+                yield idle()
+            self._busy_until = now() + 0.005
+            yield self._aa()
+        elif cmd == 0xcc:
+            yield rx_bytes(2)
+            version = (self.version << 5) & 0xff
+            yield tx_bytes(bytearray((version, version)))
+        yield idle()
+
+class Bus(object):
+
+    def __init__(self, pin, devices):
+        self.pin = pin
+        self.devices = devices
+        self.low_since = None
+        self.pulls = []
+
+    def falling(self):
+        self.low_since = now()
+        for device in self.devices:
+            op = device.op
+            if op is not None and op[0] == "tx":
+                bit = op[1]
+                if callable(bit):
+                    bit = bit()
+                if bit == 0:
+                    self.pulls.append((self.low_since, self.low_since + device.hold()))
+
+    def rising(self):
+        held = now() - self.low_since
+        self.low_since = None
+        released = now()
+        for device in self.devices:
+            presence = device.slot(held)
+            if presence is not None:
+                self.pulls.append((released + presence[0], released + presence[1]))
+
+    def sample(self):
+        if self.low_since is not None:
+            return 0
+        t = now()
+        self.pulls = [p for p in self.pulls if p[1] > t]
+        for start, end in self.pulls:
+            if start <= t < end:
+                return 0
+        return 1
+
+    # Wait until the line reaches level, used by MPSSE wait on IO
+    def wait_for(self, ctx, level, timeout=1.0):
+        if self.sample() == level:
+            return
+        t = now()
+        edges = sorted(set([p[0] for p in self.pulls] + [p[1] for p in self.pulls]))
+        for edge in edges:
+            if edge > t:
+                ctx.adapter.bus_time += edge - now()
+                if self.sample() == level:
+                    return
+        # Nothing changes, pretend the MPSSE waited for the timeout
+        ctx.adapter.bus_time += t + timeout - now()
+
+# Simulated USB attached FT232H adapters
+class Adapter(object):
+
+    def __init__(self, serial, bus=1, address=1):
+        self.serial = serial
+        self.bus = bus
+        self.address = address
+        self.pins = {}
+        self.bus_time = 0.0
+
+_adapters = [ Adapter("FTSIM000", 1, 1) ]
+
+def add_adapter(serial, bus=1, address=None):
+    if address is None:
+        address = len(_adapters) + 1
+    _adapters.append(Adapter(serial, bus, address))
+    return len(_adapters) - 1
+
+# Attach a simulated slave to the 1-Wire bus on pin
+def attach(pin, device, adapter=0):
+    _adapters[adapter].pins.setdefault(pin, []).append(device)
+    return device
+
+def detach(pin, device, adapter=0):
+    _adapters[adapter].pins[pin].remove(device)
+
+def reset_all():
+    del _adapters[1:]
+    _adapters[0].pins = {}
+    _totals.clear()
+
+_totals = {}
+
+# Simulated time which has passed on an adapter's bus, in seconds
+def sim_time(adapter=0):
+    return _adapters[adapter].bus_time + _clock["slept"]
+
+def stats():
+    return dict(_totals)
+
+def _count(key, value=1):
+    _totals[key] = _totals.get(key, 0) + value
+
+class Context(object):
+
+    def __init__(self):
+        self.adapter = None
+        self.level = 0
+        self.direction = 0
+        self.divisor = 0
+        self.rx = bytearray()
+        self.buses = []
+        self.latency = 16
+        self.chunksize = 4096
+        self.stats = {}
+        self.wall = 0.0
+
+    # Current time on this adapter's bus
+    def now(self):
+        return self.adapter.bus_time + _clock["slept"] + self.wall
+
+    def sync(self):
+        if not _clock["virtual"]:
+            self.wall = _real_time() - _clock["start"]
+
+    def count(self, key, value=1):
+        self.stats[key] = self.stats.get(key, 0) + value
+        _count(key, value)
+
+    def delay(self, clocks):
+        self.adapter.bus_time += clocks / (BASE_CLOCK / (1 + self.divisor))
+
+    def gpio(self):
+        for bus in self.buses:
+            mask = 1 << bus.pin
+            low = (self.direction & mask) and not (self.level & mask)
+            if low and bus.low_since is None:
+                bus.falling()
+            elif not low and bus.low_since is not None:
+                bus.rising()
+
+    def sample(self, high):
+        value = 0
+        for i in range(8):
+            pin = i + 8 if high else i
+            mask = 1 << pin
+            if self.direction & mask:
+                bit = 1 if self.level & mask else 0
+            else:
+                bit = 1
+            for bus in self.buses:
+                if bus.pin == pin:
+                    bit = bus.sample()
+            value |= bit << i
+        return value
+
+    def respond(self, data):
+        if len(self.rx) + len(data) > RX_FIFO:
+            self.count("stalls")
+        self.rx.extend(data)
+
+    def process(self, data):
+        i = 0
+        while i < len(data):
+            cmd = data[i]
+            if cmd == 0x80:
+                self.level = (self.level & 0xff00) | data[i+1]
+                self.direction = (self.direction & 0xff00) | data[i+2]
+                self.gpio()
+                i += 3
+            elif cmd == 0x82:
+                self.level = (self.level & 0xff) | (data[i+1] << 8)
+                self.direction = (self.direction & 0xff) | (data[i+2] << 8)
+                self.gpio()
+                i += 3
+            elif cmd == 0x81:
+                self.respond(bytearray((self.sample(False),)))
+                i += 1
+            elif cmd == 0x83:
+                self.respond(bytearray((self.sample(True),)))
+                i += 1
+            elif cmd == 0x86:
+                self.divisor = data[i+1] | (data[i+2] << 8)
+                i += 3
+            elif cmd == 0x8e:
+                self.delay(data[i+1] + 1)
+                i += 2
+            elif cmd == 0x8f:
+                self.delay(((data[i+1] | (data[i+2] << 8)) + 1) * 8)
+                i += 3
+            elif cmd == 0x4a:
+                self.delay(data[i+1] + 1)
+                i += 3
+            elif cmd in (0x88, 0x89):
+                for bus in self.buses:
+                    if bus.pin == 5:
+                        bus.wait_for(self, 1 if cmd == 0x88 else 0)
+                i += 1
+            elif cmd in (0x87, 0x8a, 0x8b, 0x8c, 0x8d, 0x96, 0x97):
+                i += 1
+            else:
+                self.respond(bytearray((0xfa, cmd)))
+                i += 1
+
+# ftdi1 API
+
+def new():
+    return Context()
+
+def free(ctx):
+    ctx.adapter = None
+
+def _open(ctx, index):
+    if index is None or index >= len(_adapters):
+        return -3
+    ctx.adapter = _adapters[index]
+    ctx.buses = [ Bus(pin, devices) for pin, devices in ctx.adapter.pins.items() ]
+    return 0
+
+def usb_open(ctx, vid, pid):
+    return _open(ctx, 0)
+
+def usb_open_desc_index(ctx, vid, pid, description, serial, index):
+    matches = [ i for i, a in enumerate(_adapters) if serial is None or a.serial == serial ]
+    if index >= len(matches):
+        return -3
+    return _open(ctx, matches[index])
+
+def usb_open_bus_addr(ctx, bus, addr):
+    for i, a in enumerate(_adapters):
+        if a.bus == bus and a.address == addr:
+            return _open(ctx, i)
+    return -3
+
+def usb_open_string(ctx, description):
+    kind, _, rest = description.partition(":")
+    if kind == "d":
+        bus, _, addr = rest.partition("/")
+        return usb_open_bus_addr(ctx, int(bus), int(addr))
+    parts = rest.split(":")
+    if kind == "i":
+        index = int(parts[2]) if len(parts) > 2 else 0
+        return _open(ctx, index if index < len(_adapters) else None)
+    if kind == "s":
+        return usb_open_desc_index(ctx, 0, 0, None, parts[2], 0)
+    return -11
+
+class _Device(object):
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+class _Node(object):
+    def __init__(self, dev, next):
+        self.dev = dev
+        self.next = next
+
+def usb_find_all(ctx, vid, pid):
+    node = None
+    for adapter in reversed(_adapters):
+        node = _Node(_Device(adapter), node)
+    return len(_adapters), node
+
+def list_free(devlist):
+    pass
+
+def usb_get_strings(ctx, dev):
+    return 0, "FTDI", "Simulated FT232H", dev.adapter.serial
+
+def usb_reset(ctx):
+    ctx.rx = bytearray()
+    return 0
+
+def usb_purge_buffers(ctx):
+    ctx.rx = bytearray()
+    return 0
+
+def read_data_set_chunksize(ctx, size):
+    return 0
+
+def write_data_set_chunksize(ctx, size):
+    ctx.chunksize = size
+    return 0
+
+def set_bitmode(ctx, mask, mode):
+    return 0
+
+def set_latency_timer(ctx, latency):
+    ctx.latency = latency
+    return 0
+
+# CPU time spent emulating is counted in emulator_seconds, so benchmarks can
+# take it away from their own.
+def write_data(ctx, data, length):
+    start = time.clock()
+    with _lock:
+        ctx.sync()
+        _active[0] = ctx
+        try:
+            data = bytearray(data[:length])
+            ctx.count("writes")
+            ctx.count("transfers_out", (length + ctx.chunksize - 1) // ctx.chunksize)
+            ctx.count("bytes_written", length)
+            ctx.process(data)
+        finally:
+            _active[0] = None
+        ctx.count("emulator_seconds", time.clock() - start)
+    return length
+
+def read_data(ctx, length):
+    start = time.clock()
+    with _lock:
+        ctx.count("reads")
+        data = ctx.rx[:length]
+        del ctx.rx[:length]
+        if not data:
+            ctx.count("empty_reads")
+        ctx.count("bytes_read", len(data))
+        ctx.count("emulator_seconds", time.clock() - start)
+    return len(data), bytes(data)
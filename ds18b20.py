@@ -10,67 +10,398 @@
 # Temp Spec
 # http://datasheets.maximintegrated.com/en/ds/DS18B20.pdf
 #
-# command_buffer management is disabled, because per byte buffering in parent
-# seems to be faster, than buffering long command strings.
 
-from w1ftdi import W1ftdi
+from w1ftdi import W1ftdi, FT232H_RX_FIFO
+from w1multi import W1multi
 import time
 import struct
 
+# How to wait for a temperature conversion
+WAIT_AUTO = "auto"    # Poll if the sensors are externally powered, else fixed
+WAIT_POLL = "poll"    # Poll read slots until the sensors report completion
+WAIT_FIXED = "fixed"  # Wait the maximum conversion time for the resolution
+
+# Maximum conversion time (seconds) for each resolution
+CONVERSION_TIME = { 3: 0.750, 2: 0.375, 1: 0.1875, 0: 0.09375 }
+POLL_INTERVAL = 0.005 # Sleep between conversion polls (seconds)
+RECALL_TIMEOUT = 0.1  # Longest to poll for a recall from EEPROM (seconds)
+
+# Calculate the temp from the scratchpad, based on the current resolution
+def _temperature(data, offset=0):
+    resolution = ( data[offset+4] >> 5) & 0b11
+    temp_register = struct.unpack_from('<h', data, offset)[0]
+    if resolution == 3:
+        temperature = float(temp_register) / 16.0
+    elif resolution == 2:
+        temperature = float(temp_register >> 1) / 8.0 
+    elif resolution == 1:
+        temperature = float(temp_register >> 2) / 4.0 
+    elif resolution == 0:
+        temperature = float(temp_register >> 3) / 2.0 
+    else:
+        raise Exception("Unknown Resolution")
+    return temperature
+
 class Ds18b20(W1ftdi):
 
+    FAMILY = 0x28
+
+    _instrumented = W1ftdi._instrumented + ("get_temp", "get_temps", "convert_all", "read_temps",
+                                            "get_config", "set_config", "save_config",
+                                            "recall_config", "is_parasite")
 
     # init
-    def __init__(self, pin, debug=0, rom=None):
+    def __init__(self, pin, debug=0, rom=None, wait=WAIT_AUTO, device=None):
         self.rom = rom
-        super(Ds18b20, self).__init__(pin, debug)
+        self.wait = wait
+        self.conversion_time = None
+        self._conversion_start = None
+        self._parasite = {}
+        self._resolutions = {}
+        super(Ds18b20, self).__init__(pin, debug, device=device)
         self.open()
         self.sync()
         self.setup_clock()
         self.res = { 3: "12 bit", 2: "11 bit", 1: "10 bit", 0: "9 bit" }
-        
+        self._scratchpads = bytearray()
+
     # Read Temperature 
     def get_temp(self):
+        wait = self._start_conversion(self.rom)
+        self._wait_conversion(wait, self._resolutions.get(self.rom, 3))
+        return self._read_temp(self.rom)
+
+    # Ask the sensor (or every sensor if rom is None) to take a measurement.
+    # Returns how we need to wait for it.
+    def _start_conversion(self, rom):
+
+        # Find out how to wait for the conversion
+        wait = self.wait
+        if wait == WAIT_AUTO:
+            wait = WAIT_FIXED if self.is_parasite(rom) else WAIT_POLL
 
         # Reset the line, bail if no devices
         if self.reset() is False:
             raise Exception("No Device")
 
         # Ask Sesnsor to take a measurement
-        #self.enable_command_buffer()
-        self.address_rom(self.rom)
-        self.write_byte(0x44)
-        #self.flush_command_buffer()
-        self._debug(1, "TEMP: Waiting for measurement")
-        time.sleep(1)
-
-        # Read the data from the Sensor
-        self.reset()
-        #self.enable_command_buffer()
-        self.address_rom(self.rom)
-        self.write_byte(0xbe)
-        #self.flush_command_buffer()
-        data = self.read_bytes(9)
+        with self.command_buffer():
+            self.address_rom(rom)
+            self.write_byte(0x44)
+        self._conversion_start = time.time()
+        return wait
+
+    # Read the data from the Sensor, once the conversion is complete
+    def _read_temp(self, rom):
+        data = self.read_each([ rom ], 0xbe, 9)
 
         # Check the CRC on the data:
-        if self.crc(data) is not 0x00:
+        if self.crc(data) != 0:
             self._debug(1, "TEMP: CRC Check Failed")
+            self._crc_failure(rom)
             raise Exception("CRC Check Failed")
+        self._resolutions[rom] = ( data[4] >> 5) & 0b11
+        return self._decode_temp(data)
+
+    # The ROMs to configure, a list of ROMs, a single ROM, or None for self.rom
+    def _targets(self, roms):
+        if roms is None:
+            return [ self.rom ]
+        if type(roms) is str:
+            return [ roms ]
+        return list(roms)
+
+    # Read the configuration of the sensors, returns a dict of ROM:
+    # (resolution in bits, TH, TL), where TH and TL are the alarm temperatures.
+    def get_config(self, roms=None):
+        targets = self._targets(roms)
+        data = self.read_each(targets, 0xbe, 9)
+        config = {}
+        for i, rom in enumerate(targets):
+            scratchpad = data[i*9:(i+1)*9]
+            if self.crc(scratchpad) != 0:
+                self._crc_failure(rom)
+                raise Exception("CRC Check Failed for {}".format(rom))
+            resolution = ( scratchpad[4] >> 5) & 0b11
+            self._resolutions[rom] = resolution
+            th, tl = struct.unpack('bb', str(scratchpad[2:4]))
+            config[rom] = (resolution + 9, th, tl)
+        return config
+
+    # Return the resolution (9 to 12 bits) of a sensor
+    def get_resolution(self, rom=None):
+        return self.get_config(rom).values()[0][0]
 
-        # Calculate the temp based on the current resolution
-        resolution = ( data[4] >> 5) & 0b11
-        temp_register = struct.unpack('<h', data[0:2])[0]
-        if resolution == 3:
-            temperature = float(temp_register) / 16.0
-        elif resolution == 2:
-            temperature = float(temp_register >> 1) / 8.0 
-        elif resolution == 1:
-            temperature = float(temp_register >> 2) / 4.0 
-        elif resolution == 0:
-            temperature = float(temp_register >> 3) / 2.0 
+    # Configure the resolution (9 to 12 bits) and/or alarm temperatures of the
+    # sensors. The current configuration of each sensor is read first, so
+    # anything not given is left as it is. The change is verified by reading
+    # the scratchpads back, and copied to EEPROM if persist is set.
+    def set_config(self, resolution=None, th=None, tl=None, roms=None, persist=False):
+        if resolution is not None and resolution not in (9, 10, 11, 12):
+            raise ValueError("Resolution must be 9 to 12 bits")
+        for alarm in (th, tl):
+            if alarm is not None and not -128 <= alarm <= 127:
+                raise ValueError("Alarm temperatures must be -128 to 127")
+        targets = self._targets(roms)
+        current = self.get_config(targets)
+        wanted = {}
+        per_write = FT232H_RX_FIFO // 4
+        for i, rom in enumerate(targets):
+            if i % per_write == 0:
+                self.enable_command_buffer()
+            config = ( resolution if resolution is not None else current[rom][0],
+                       th if th is not None else current[rom][1],
+                       tl if tl is not None else current[rom][2] )
+            wanted[rom] = config
+            self._debug(1, "TEMP: Configuring {}: {} bit, TH {}, TL {}", rom, *config)
+            self._write(self._reset_command())
+            self.address_rom(rom)
+            self.write_byte(0x4e)
+            self.write_byte(config[1] & 0xff)
+            self.write_byte(config[2] & 0xff)
+            self.write_byte(((config[0] - 9) << 5) | 0x1f)
+
+            # Send a FIFO full at a time, discarding the presence responses
+            if (i + 1) % per_write == 0 or i + 1 == len(targets):
+                self._write(self.send_immediate)
+                self.flush_command_buffer()
+                self._read(4 * ((i % per_write) + 1))
+
+        # Verify
+        if self.get_config(targets) != wanted:
+            raise Exception("Configuration Verify Failed")
+        if persist:
+            self.save_config(targets)
+
+    # Set the resolution (9 to 12 bits) of the sensors
+    def set_resolution(self, resolution, roms=None, persist=False):
+        self.set_config(resolution, roms=roms, persist=persist)
+
+    # Copy the scratchpad configuration (TH, TL, resolution) to EEPROM, this
+    # takes up to 10ms, and parasite powered sensors need the strong pullup.
+    def save_config(self, roms=None):
+        for rom in self._targets(roms):
+            self._debug(1, "TEMP: Saving configuration of {} to EEPROM", rom)
+            if self.reset() is False:
+                raise Exception("No Device")
+            self.enable_command_buffer()
+            self.address_rom(rom)
+            self.write_byte(0x48)
+            self.pullup_and_check(10)
+
+    # Reload the configuration of the sensors from EEPROM into the scratchpad
+    def recall_config(self, roms=None):
+        targets = self._targets(roms)
+        for rom in targets:
+            self._debug(1, "TEMP: Recalling configuration of {} from EEPROM", rom)
+            if self.reset() is False:
+                raise Exception("No Device")
+            self.enable_command_buffer()
+            self.address_rom(rom)
+            self.write_byte(0xb8)
+            self._wait_recall()
+        return self.get_config(targets)
+
+    # Poll read slots until the recall from EEPROM is done, the sensor holds
+    # them low until it is. The first poll sends the buffered recall command.
+    def _wait_recall(self):
+        start = time.time()
+        while self.read_bytes(1)[0] == 0x00:
+            if time.time() - start > RECALL_TIMEOUT:
+                raise Exception("Recall Timeout")
+            self._sleep(POLL_INTERVAL)
+
+    # Ask whether the addressed sensor (or any sensor if rom is None) is
+    # parasite powered, using Read Power Supply. Cached per ROM.
+    def is_parasite(self, rom=None):
+        if rom not in self._parasite:
+            if self.reset() is False:
+                raise Exception("No Device")
+            self.enable_command_buffer()
+            self.address_rom(rom)
+            self.write_byte(0xb4)
+            self._parasite[rom] = self.read_bytes(1)[0] & 0x01 == 0
+            self._debug(1, "TEMP: Parasite power: {}", self._parasite[rom])
+        return self._parasite[rom]
+
+    # Wait for the conversion just started. Externally powered sensors hold
+    # the read slots low until the conversion completes, so they can be polled
+    # (WAIT_POLL). Parasite powered ones can't signal, so we wait the maximum
+    # conversion time for the resolution (WAIT_FIXED).
+    def _wait_conversion(self, wait, resolution):
+        if wait == WAIT_POLL:
+            self._debug(1, "TEMP: Polling for measurement")
+            while not self._conversion_done(self.read_byte()):
+                self._sleep(POLL_INTERVAL)
         else:
-            raise Exception("Unknown Resolution")
-        self._debug(1, "TEMP: Resolution: {}".format(self.res[resolution]))
-        self._debug(1, "TEMP: Data: {}".format( self.bytes2string(data)))
+            self._debug(1, "TEMP: Waiting for measurement")
+            self._sleep(CONVERSION_TIME[resolution])
+            self._conversion_done()
+
+    # Check a conversion poll, and record the conversion time once complete in
+    # conversion_time.
+    def _conversion_done(self, poll=0xff):
+        elapsed = time.time() - self._conversion_start
+        if poll == 0x00:
+            if elapsed > CONVERSION_TIME[3] * 2:
+                raise Exception("Conversion Timeout")
+            return False
+        self.conversion_time = elapsed
+        self._debug(1, "TEMP: Conversion took {:.1f}ms", self.conversion_time * 1000)
+        return True
+
+    # Calculate the temp from the scratchpad, based on the current resolution
+    def _decode_temp(self, data, offset=0):
+        temperature = _temperature(data, offset)
+        if self._dbg >= 1:
+            resolution = ( data[offset+4] >> 5) & 0b11
+            self._debug(1, "TEMP: Resolution: {}", self.res[resolution])
+            self._debug(1, "TEMP: Data: {}", self.bytes2string(data[offset:offset+9]))
         return temperature
-        
+
+    # Ask every sensor on the bus to take a measurement at once. Only for
+    # externally powered sensors, parasite powered ones need a strong pullup.
+    def convert_all(self):
+        return self._start_conversion(None)
+
+    # Read the temperature from many sensors. They all convert together, we
+    # wait once, and then read the scratchpads back to back. Returns a dict of
+    # ROM: temperature, where the temperature is None if the CRC failed.
+    def get_temps(self, roms=None):
+        if roms is None:
+            roms = self.search_roms(family=self.FAMILY)
+        wait = self.convert_all()
+        self._wait_conversion(wait, self._max_resolution(roms))
+        return self.read_temps(roms)
+
+    # The highest resolution we know of amongst the sensors
+    def _max_resolution(self, roms):
+        return max([ self._resolutions.get(rom, 3) for rom in roms ] or [3])
+
+    # Read and decode the scratchpads of the sensors, without converting.
+    # Scratchpads are read into one buffer which is reused between calls.
+    def read_temps(self, roms):
+        if len(self._scratchpads) != 9 * len(roms):
+            self._scratchpads = bytearray(9 * len(roms))
+        data = self.read_each(roms, 0xbe, 9, self._scratchpads)
+        temps = {}
+        for i, rom in enumerate(roms):
+            if self.crc(data[i*9:(i+1)*9]) != 0:
+                self._debug(1, "TEMP: CRC Check Failed for {}", rom)
+                self._crc_failure(rom)
+                temps[rom] = None
+            else:
+                self._resolutions[rom] = ( data[i*9+4] >> 5) & 0b11
+                temps[rom] = self._decode_temp(data, i*9)
+        return temps
+
+    # Continuously sample the sensors, every rate seconds. Yields a tuple of
+    # (timestamp, temps) for each sample, count samples or forever.
+    def sample(self, roms=None, rate=1.0, count=None):
+        if roms is None:
+            roms = self.search_roms(family=self.FAMILY)
+        samples = 0
+        due = time.time()
+        while True:
+            temps = self.get_temps(roms)
+            yield (time.time(), temps)
+            samples += 1
+            if count is not None and samples >= count:
+                return
+            due += rate
+            delay = due - time.time()
+            if delay > 0:
+                self._sleep(delay)
+            else:
+                due = time.time()
+
+    # Continuously sample the sensors, calling callback(timestamp, temps) with
+    # each sample.
+    def poll(self, callback, roms=None, rate=1.0, count=None):
+        for timestamp, temps in self.sample(roms, rate, count):
+            callback(timestamp, temps)
+
+# DS18B20s on several buses of one FT232H, converted and read in lock-step.
+# See W1multi. Takes and returns a list with an entry per bus.
+class Ds18b20multi(W1multi):
+
+    FAMILY = 0x28
+
+    _instrumented = W1multi._instrumented + ("is_parasite_all", "convert_all", "get_temps",
+                                             "read_temps")
+
+    def __init__(self, pins, debug=0, wait=WAIT_AUTO, device=None):
+        self.wait = wait
+        self.conversion_time = None
+        self._conversion_start = None
+        self._parasite = None
+        self._resolutions = {}
+        super(Ds18b20multi, self).__init__(pins, debug, device=device)
+        self.open()
+        self.sync()
+        self.setup_clock()
+
+    # Find the DS18B20s on every bus
+    def search_roms_all(self):
+        return self.search_all(family=self.FAMILY)
+
+    # Ask whether any sensor on each bus is parasite powered, using Read Power
+    # Supply on every bus at once. Cached.
+    def is_parasite_all(self):
+        if self._parasite is None:
+            self.reset_all()
+            self.enable_command_buffer()
+            self.write_bytes_all('\xcc\xb4')
+            self._parasite = [ bits[0] == 0 for bits in self.read_bits_all(1) ]
+            self._debug(1, "TEMP: Parasite power: {}", self._parasite)
+        return self._parasite
+
+    # Ask every sensor on the active buses to take a measurement at once, and
+    # wait for them. Only for externally powered sensors, parasite powered ones
+    # need a strong pullup.
+    def convert_all(self, active=None):
+        wait = self.wait
+        if wait == WAIT_AUTO:
+            wait = WAIT_FIXED if True in self.is_parasite_all() else WAIT_POLL
+        present = self.reset_all(active)
+        if True not in present:
+            raise Exception("No Device")
+        self.write_bytes_all([ None if p is None else '\xcc\x44' for p in present ])
+        self._conversion_start = time.time()
+        if wait == WAIT_POLL:
+            self._debug(1, "TEMP: Polling for measurement")
+            while 0 in [ bits[0] for bits in self.read_bits_all(1, present) if bits is not None ]:
+                if time.time() - self._conversion_start > CONVERSION_TIME[3] * 2:
+                    raise Exception("Conversion Timeout")
+                self._sleep(POLL_INTERVAL)
+        else:
+            self._debug(1, "TEMP: Waiting for measurement")
+            self._sleep(CONVERSION_TIME[max(self._resolutions.values() or [3])])
+        self.conversion_time = time.time() - self._conversion_start
+
+    # Read the temperature from the sensors on every bus, converting them all
+    # together. roms holds a list of ROMs per bus, or None to search for them.
+    # Returns a dict of ROM: temperature per bus, where the temperature is None
+    # if the CRC failed.
+    def get_temps(self, roms=None):
+        if roms is None:
+            roms = self.search_roms_all()
+        self.convert_all([ bus if bus else None for bus in roms ])
+        return self.read_temps(roms)
+
+    # Read and decode the scratchpads of the sensors on every bus, without
+    # converting.
+    def read_temps(self, roms):
+        results = []
+        for bus, data in zip(roms, self.read_each_all(roms, 0xbe, 9)):
+            temps = {}
+            for i, rom in enumerate(bus or []):
+                if self.crc(data[i*9:(i+1)*9]) != 0:
+                    self._debug(1, "TEMP: CRC Check Failed for {}", rom)
+                    self._crc_failure(rom)
+                    temps[rom] = None
+                else:
+                    self._resolutions[rom] = ( data[i*9+4] >> 5) & 0b11
+                    temps[rom] = _temperature(data, i*9)
+            results.append(temps)
+        return results
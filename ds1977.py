@@ -12,17 +12,29 @@
 #
 
 from w1ftdi import W1ftdi
+from w1crc import Crc
+from w1cache import W1pagecache, CAPACITY
+import io
+import os
 import time
 import struct
 
+RETRIES = 3           # Times a page failing its CRC is read again
+
 class Ds1977(W1ftdi):
 
+    FAMILY = 0x37
+
+    _instrumented = W1ftdi._instrumented + ("get_version", "write_scratchpad", "read_scratchpad",
+                                            "copy_scratchpad", "read_pages", "read_memory",
+                                            "write_memory", "flush_cache", "change_passwords",
+                                            "enable_passwords")
 
     # init
-    def __init__(self, pin, debug=0, rom=None, pullup=None):
+    def __init__(self, pin, debug=0, rom=None, pullup=None, device=None):
 
         # super
-        super(Ds1977, self).__init__(pin, debug, pullup=pullup, overdrive=True)
+        super(Ds1977, self).__init__(pin, debug, pullup=pullup, overdrive=True, device=device)
 
         # vars
         self.rom     = rom
@@ -37,6 +49,9 @@ class Ds1977(W1ftdi):
         self._last_byte    = 0x7FBF # 32703
         self._pages        = 0x01FF # 511
         self._page_length  = 0x003F # 63
+        self.last_dump     = None
+        self.cache         = None
+        self._cache_rom    = None
 
         # Init FTDI 1-Wire
         self.open()
@@ -79,25 +94,21 @@ class Ds1977(W1ftdi):
             self._write_scratchpad(ta1, ta2, data)
             if len(data) == 64:
                 # Verify the CRC only if we wrote the entire page
-                crc = self.read_bytes(2)
-                crc[0] ^= 0xff
-                crc[1] ^= 0xff
-                check = bytearray((0x0f, ta1, ta2))
-                check.extend(data)
-                check.extend(crc)
-                if self.crc(check, bits=16) != 00:
+                crc = Crc(16).update((0x0f, ta1, ta2)).update(data)
+                crc.update_inverted(self.read_bytes(2))
+                if not crc.valid():
+                    self._crc_failure(self.rom)
                     raise Exception("CRC16 Check Failed")
                 return True
         return False
 
     def _write_scratchpad(self, ta1, ta2, data):
         if self._ready():
-            self.enable_command_buffer()
-            self.write_byte( 0x0f )
-            self.write_byte( ta1 )
-            self.write_byte( ta2 )
-            self.write_bytes( data )
-            self.flush_command_buffer()
+            with self.command_buffer():
+                self.write_byte( 0x0f )
+                self.write_byte( ta1 )
+                self.write_byte( ta2 )
+                self.write_bytes( data )
 
     # Read Scratchpad and return a tuple representing: (TA1, TA2, ES, DATA)
     def read_scratchpad(self, length):
@@ -124,56 +135,429 @@ class Ds1977(W1ftdi):
 
     def clear_scratchpad(self, length):
         if self._ready():
-            self.enable_command_buffer()
             data = bytearray(length)
-            self.write_byte( 0x0f )
-            self.write_byte( 0x00 )
-            self.write_byte( 0x00 )
-            self.write_bytes( data )
-            self.flush_command_buffer()
-
+            with self.command_buffer():
+                self.write_byte( 0x0f )
+                self.write_byte( 0x00 )
+                self.write_byte( 0x00 )
+                self.write_bytes( data )
+
+    # Write data to memory starting at offset, across as many pages as it
+    # takes, with password being the full access password. Returns the number
+    # of pages written. With differential, the pages are read first, and only
+    # those which would change are written.
+    #
+    # Each page goes through the scratchpad, which is written, read back and
+    # checked in a single round trip, along with checking the copy of the page
+    # before, so a page costs a round trip and the 10ms copy. A page which
+    # fails the check is written to the scratchpad again, up to RETRIES times.
+    #
+    # With the cache enabled, the pages are updated in the cache, and written
+    # by flush_cache(). Returns the number of pages changed.
+    def write_memory(self, offset, data, password, differential=False):
+        chunks = self._chunks(offset, data)
+        if self.cache is not None:
+            return self._cache_write(chunks, bytearray(password))
+        return self._write_chunks(chunks, bytearray(password), differential)
+
+    # Split data to be written at offset into a (address, data) chunk for
+    # each page it covers
+    def _chunks(self, offset, data):
+        if type(data) is str:
+            data = bytearray( data )
+        if offset < 0 or offset + len(data) - 1 > self._last_byte:
+            raise Exception("Please use change_passwords() and enable_passwords() to manage security.")
+        chunks = []
+        address = offset
+        while address < offset + len(data):
+            end = min((address | 0x3f) + 1, offset + len(data))
+            chunks.append((address, data[address - offset:end - offset]))
+            address = end
+        return chunks
+
+    # Write the chunks to memory, see write_memory()
+    def _write_chunks(self, chunks, password, differential=False):
+        if differential:
+            chunks = self._changed_chunks(chunks, password)
+        if not chunks:
+            return 0
+        if not self._ready():
+            raise Exception("No Device")
+        down = False
+        failures = 0
+        i = 0
+        while i < len(chunks):
+            address, chunk = chunks[i]
+            transfers = self._scratchpad_transfers(address, chunk)
+            if down is not False:
+                transfers = self._copy_check_transfers(down) + transfers
+            responses = list(self.stream(transfers))
+            if down is not False:
+                self._check_copy(responses[:2])
+                responses = responses[2:]
+                down = False
+            if not self._scratchpad_valid(address, chunk, responses):
+                failures += 1
+                self._debug(1, "DS1977: Scratchpad check failed at {:04x}, retry {}", address, failures)
+                if failures > RETRIES:
+                    raise Exception("Scratch Pad differs")
+                continue
+            failures = 0
+            es = (address & 0x3f) + len(chunk) - 1
+            self.enable_command_buffer()
+            self._write(self._reset_command())
+            self.resume()
+            self.write_bytes(bytearray((0x99, address & 0xff, address >> 8, es)) + password)
+            down = self._pullup_start(10)
+            self._sleep(self._pullup_seconds(10))
+            i += 1
+        self._check_copy(list(self.stream(self._copy_check_transfers(down))))
+        return len(chunks)
+
+    # The chunks, a list of (address, data), whose data differs from what's
+    # in memory now
+    def _changed_chunks(self, chunks, password):
+        if not chunks:
+            return []
+        first = chunks[0][0] // 64
+        last = chunks[-1][0] // 64
+        current = dict(self.dump(password, first, last - first + 1))
+        changed = []
+        for address, chunk in chunks:
+            offset = address & 0x3f
+            if current[address // 64][offset:offset + len(chunk)] != chunk:
+                changed.append((address, chunk))
+        self._debug(1, "DS1977: {} of {} pages changed", len(changed), len(chunks))
+        return changed
+
+    # The transfers for stream() to write chunk to the scratchpad at address,
+    # and read it back. The responses are the presence and (for a write to
+    # the end of the scratchpad) the CRC of the write, the presence for the
+    # read, and then the read back data in pieces.
+    def _scratchpad_transfers(self, address, chunk):
+        ta1 = address & 0xff
+        ta2 = address >> 8
+        full = (address & 0x3f) + len(chunk) == 64
+        def write():
+            self._write(self._reset_command())
+            self.resume()
+            self.write_bytes(bytearray((0x0f, ta1, ta2)) + chunk)
+            if full:
+                self._write(self._read_commands(16))
+        def read():
+            self._write(self._reset_command())
+            self.resume()
+            self.write_byte(0xaa)
+        transfers = [ (write, 4 + (32 if full else 0)), (read, 4) ]
+        count = 3 + len(chunk) + 2
+        for start in range(0, count, 32):
+            size = min(32, count - start)
+            transfers.append((self._read_commands(8 * size), 16 * size))
+        return transfers
+
+    # The transfers for stream() to finish a copy started by write_memory(),
+    # once the time is up. The responses are the presence for the copy, and
+    # the first byte after it.
+    def _copy_check_transfers(self, down):
+        commands = self._read_commands(8)
+        if down is not None:
+            commands = str(down) + commands
+        return [ ("", 4), (commands, 16) ]
+
+    # Check the responses from _copy_check_transfers()
+    def _check_copy(self, responses):
+        if self._decode_bits(responses[0])[0] != 0:
+            raise Exception("No Device")
+        if self._pack_bits(self._decode_bits(responses[1]))[0] != 0xaa:
+            raise Exception("Copy Scratchpad Failed!")
+
+    # Check the responses from _scratchpad_transfers(), the CRC of the write
+    # if there is one, and that the scratchpad holds chunk at address
+    def _scratchpad_valid(self, address, chunk, responses):
+        ta1 = address & 0xff
+        ta2 = address >> 8
+        if self._decode_bits(responses[0][:4])[0] != 0 or self._decode_bits(responses[1])[0] != 0:
+            raise Exception("No Device")
+        if len(responses[0]) > 4:
+            crc = Crc(16).update((0x0f, ta1, ta2)).update(chunk)
+            crc.update_inverted(self._pack_bits(self._decode_bits(responses[0][4:])))
+            if not crc.valid():
+                self._crc_failure(self.rom)
+                return False
+        data = self._pack_bits(self._decode_bits(bytearray().join(responses[2:])))
+        crc = Crc(16).update((0xaa,)).update(data[:-2])
+        crc.update_inverted(data[-2:])
+        if not crc.valid():
+            self._crc_failure(self.rom)
+            return False
+        es = (address & 0x3f) + len(chunk) - 1
+        return data[:-2] == bytearray((ta1, ta2, es)) + chunk
+
+    # Read number pages from page start, returns a list with the data of each.
+    # Served from the cache if it's enabled.
     def read_pages(self, start, password, number=1):
         pages = self._pages - (start+number)
         if pages < 0 or pages > self._pages:
             raise Exception("DS1977 has 511 (0-510) user addressable pages")
-        start = start * 64 
-        return self.read_memory(start&0xff, start>>8, password, number)
+        if self.cache is not None:
+            if number == 0:
+                number = self._pages - start
+            return [ bytearray(data) for data in self._cache_read(start, number, password) ]
+        return [ data for page, data in self.dump(password, start, number) ]
+
+    # Cache the pages read and written, up to capacity pages, see w1cache.py.
+    # Repeated reads of cached pages don't touch the bus, and writes stay in
+    # the cache until flush_cache() or close(). The clean pages are dropped if
+    # the device stops answering a reset, or rom is changed. dump() and
+    # read_memory() always read the device. Returns the W1pagecache.
+    def enable_cache(self, capacity=CAPACITY, cache=None):
+        self.cache = cache if cache is not None else W1pagecache(capacity)
+        self._cache_rom = self.rom
+        return self.cache
+
+    # Write back the cache, and stop using it. Returns the W1pagecache.
+    def disable_cache(self):
+        cache = self.cache
+        if cache is not None:
+            self.flush_cache()
+        self.cache = None
+        return cache
+
+    # Write the dirty pages in the cache back to their devices
+    def flush_cache(self):
+        if self.cache is not None:
+            self._write_back(self.cache.dirty())
+
+    # Write back a list of (rom, page, data, password), each run of pages
+    # for a ROM going in one write_memory()
+    def _write_back(self, pages):
+        rom = self.rom
+        try:
+            run = []
+            for entry in sorted(pages) + [ None ]:
+                if run and (entry is None or entry[0] != run[-1][0] or
+                            entry[1] != run[-1][1] + 1 or entry[3] != run[-1][3]):
+                    self._write_run(run)
+                    run = []
+                if entry is not None:
+                    run.append(entry)
+        finally:
+            if self.rom != rom:
+                self.rom = rom
+                self._rc = False
+
+    # Write back a run of consecutive pages for a ROM
+    def _write_run(self, run):
+        if self.rom != run[0][0]:
+            self.rom = run[0][0]
+            self._rc = False
+        self._debug(1, "DS1977: Writing back {} pages from {}", len(run), run[0][1])
+        data = bytearray().join(entry[2] for entry in run)
+        self._write_chunks(self._chunks(run[0][1] * 64, data), run[0][3])
+        for rom, page, data, password in run:
+            self.cache.clean(rom, page, data)
+
+    # Drop the cached pages if rom has changed since they were read, the new
+    # device has to be addressed rather than resumed
+    def _cache_check_rom(self):
+        if self.rom != self._cache_rom:
+            self._debug(2, "DS1977: ROM changed from {} to {}, invalidating cache", self._cache_rom, self.rom)
+            if self._cache_rom is not None:
+                self.cache.invalidate(self._cache_rom)
+            self._cache_rom = self.rom
+            self._rc = False
+
+    # The data of number pages from start, reading the pages not cached in
+    # runs with dump()
+    def _cache_read(self, start, number, password):
+        self._cache_check_rom()
+        pages = {}
+        missing = []
+        for page in range(start, start + number):
+            data = self.cache.get(self.rom, page)
+            if data is None:
+                missing.append(page)
+            else:
+                pages[page] = data
+        evicted = []
+        while missing:
+            count = 1
+            while count < len(missing) and missing[count] == missing[0] + count:
+                count += 1
+            for page, data in self.dump(password, missing[0], count):
+                pages[page] = data
+                evicted.extend(self.cache.put(self.rom, page, data))
+            missing = missing[count:]
+        self._write_back(evicted)
+        return [ pages[page] for page in range(start, start + number) ]
+
+    # Update the cached pages with the chunks, returns the number changed
+    def _cache_write(self, chunks, password):
+        if not chunks:
+            return 0
+        first = chunks[0][0] // 64
+        current = self._cache_read(first, chunks[-1][0] // 64 - first + 1, password)
+        changed = 0
+        evicted = []
+        for address, chunk in chunks:
+            page = address // 64
+            data = bytearray(current[page - first])
+            offset = address & 0x3f
+            data[offset:offset + len(chunk)] = chunk
+            if data != current[page - first]:
+                evicted.extend(self.cache.put(self.rom, page, data, True, password))
+                changed += 1
+        self._write_back(evicted)
+        return changed
+
+    # A file-like object for the memory, see Ds1977file
+    def memory(self, password, write_password=None):
+        return Ds1977file(self, password, write_password)
+
+    # As W1ftdi.reset(). If there's no device present, it has to be addressed
+    # again when it comes back, and the cached pages for the ROM are dropped,
+    # as it may have been changed in the meantime.
+    def reset(self):
+        present = super(Ds1977, self).reset()
+        if not present:
+            self._rc = False
+            if self.cache is not None:
+                self._debug(2, "DS1977: No device, invalidating cache")
+                self.cache.invalidate(self.rom)
+        return present
+
+    # Write back the cache before closing
+    def close(self):
+        try:
+            if self.cache is not None and self._ctx is not None:
+                self.flush_cache()
+        finally:
+            super(Ds1977, self).close()
+
+    # Read number pages (0 for the rest of memory) starting at page start, a
+    # page at a time as they arrive. A generator, yielding (page, data) for
+    # each page, and filling buffer from its start if one is given.
+    #
+    # Each page is read back in a single round trip, and the 5ms transfer of
+    # the next page goes on while the caller handles the last. A page failing
+    # its CRC is read again, by restarting the read at that page, up to
+    # retries times. last_dump holds the progress: next_page to resume from
+    # if the dump fails, the pages and bytes read, the retries, and the
+    # throughput in bytes_per_second.
+    def dump(self, password, start=0, number=0, buffer=None, retries=RETRIES):
+        if number == 0:
+            number = self._pages - start
+        if start < 0 or number < 0 or start + number > self._pages:
+            raise Exception("DS1977 has 511 (0-510) user addressable pages")
+        end = start + number
+        page = start
+        failures = 0
+        began = time.time()
+        self.last_dump = { "next_page": start, "pages": 0, "bytes": 0, "retries": 0,
+                           "seconds": 0.0, "bytes_per_second": 0.0 }
+        while page < end:
+            address = page * 64
+            ta1 = address & 0xff
+            ta2 = address >> 8
+            pages, length = self._start_read_memory(ta1, ta2, password, end - page)
+            if pages == 0:
+                raise Exception("No Device")
+            self.enable_command_buffer()
+            down = self._pullup_start(5)
+            ready = time.time() + self._pullup_seconds(5)
+            try:
+                for i in xrange(pages):
+                    self._sleep(max(0.0, ready - time.time()))
+                    if down is not None:
+                        self._write(str(down))
+                    data = self.read_bytes(1 + length + 2)
+
+                    # The next page's transfer has started, start its wait,
+                    # and the pullup, while this one is checked and handled.
+                    down = None
+                    if i + 1 < pages:
+                        self.enable_command_buffer()
+                        down = self._pullup_start(5)
+                        ready = time.time() + self._pullup_seconds(5)
+                    if not self._page_valid(ta1, ta2, i, data):
+                        self._crc_failure(self.rom)
+                        failures += 1
+                        self.last_dump["retries"] += 1
+                        self._debug(1, "DS1977: CRC16 Check Failed on page {}, retry {}", page, failures)
+                        if failures > retries:
+                            raise Exception("CRC16 Check Failed on page {}".format(page))
+                        break
+                    response = data[:1 + length]
+                    if buffer is not None:
+                        buffer[(page - start) * 64:(page - start + 1) * 64] = response
+                    page += 1
+                    failures = 0
+                    self._dump_progress(page, began)
+                    yield page - 1, response
+            finally:
+                if down is not None:
+                    self._write(str(down))
+                self.reset()
+
+    # Update last_dump, once page is the next page to read
+    def _dump_progress(self, page, began):
+        dump = self.last_dump
+        dump["next_page"] = page
+        dump["pages"] += 1
+        dump["bytes"] += self._page_length + 1
+        dump["seconds"] = time.time() - began
+        if dump["seconds"] > 0:
+            dump["bytes_per_second"] = dump["bytes"] / dump["seconds"]
 
     # https://datasheets.maximintegrated.com/en/ds/DS1977.pdf "Transfer takes 5ms maximum"
     def read_memory(self, ta1, ta2, password, pages=1):
+        responses = []
+        pages, length = self._start_read_memory(ta1, ta2, password, pages)
+        for i in xrange(pages):
+            self.enable_command_buffer()
+            first = self.pullup_and_check(5)
+            responses.append(self._read_page(ta1, ta2, i, first, length))
+            length = self._page_length
+        self.reset()
+        return responses
+
+    # Send the read memory command, returns the number of pages to read, and
+    # the length of the first page after its first byte.
+    def _start_read_memory(self, ta1, ta2, password, pages):
         if ( (ta2<<8)+ta1 ) > self._last_byte:
             raise Exception("You can't read from there!")
-        if self._ready():
+        if not self._ready():
+            return (0, 0)
+        with self.command_buffer():
             self.write_byte( 0x69 )
             self.write_byte( ta1 )
             self.write_byte( ta2 )
             self.write_bytes( password )
-            first_page = int(((ta2<<8)+ta1) / (self._page_length + 1))
-            if pages == 0:
-                pages = self._pages - first_page 
-            page_offset = ((ta2<<8)+ta1) % (self._page_length + 1)
-            length = self._page_length - page_offset
-            responses = []
-            for i in xrange(pages):
-                self.enable_command_buffer()
-                response = chr( self.pullup_and_check(5) )
-                response += self.read_bytes(length)
-                crc = self.read_bytes(2)
-                crc[0] ^= 0xff
-                crc[1] ^= 0xff
-                if i == 0:
-                    # First page CRC includes command and address. Next pages don't
-                    check = bytearray((0x69, ta1, ta2))
-                else:
-                    check = bytearray()
-                check.extend(response)
-                check.extend(crc)
-                if self.crc(check, bits=16) != 00:
-                    raise Exception("CRC16 Check Failed")
-                responses.append(response)
-                length = self._page_length
-        self.reset()
-        return responses
+        first_page = int(((ta2<<8)+ta1) / (self._page_length + 1))
+        if pages == 0:
+            pages = self._pages - first_page 
+        page_offset = ((ta2<<8)+ta1) % (self._page_length + 1)
+        return (pages, self._page_length - page_offset)
+
+    # Read the rest of page i once its first byte has been transferred, and
+    # check the CRC. The first page CRC includes command and address, next
+    # pages don't
+    def _read_page(self, ta1, ta2, i, first, length):
+        data = bytearray(chr(first)) + self.read_bytes(length + 2)
+        if not self._page_valid(ta1, ta2, i, data):
+            self._crc_failure(self.rom)
+            raise Exception("CRC16 Check Failed")
+        return data[:1 + length]
+
+    # Check the CRC of data, page i of a read from ta1, ta2, followed by its
+    # two CRC bytes
+    def _page_valid(self, ta1, ta2, i, data):
+        crc = Crc(16)
+        if i == 0:
+            crc.update((0x69, ta1, ta2))
+        crc.update(data[:-2])
+        crc.update_inverted(data[-2:])
+        return crc.valid()
 
     # Verify the password 
     # https://datasheets.maximintegrated.com/en/ds/DS1977.pdf "Transfer takes 5ms maximum"
@@ -208,7 +592,7 @@ class Ds1977(W1ftdi):
         # Verify the Scratchpad
         self._debug(1, "Verifying passwords to Scratchpad")
         sp = self._read_scratchpad(19)
-        self._debug(2, "SP Contains: {}".format( self.bytes2string(sp) ))
+        self._debug(2, "SP Contains: {}", self.bytes2string(sp))
         if list(sp) != list([ self.read, self.passwd, 0x0f ] + [b for b in data]):
             raise Exception("Scratch Pad differs")
 
@@ -239,7 +623,7 @@ class Ds1977(W1ftdi):
         self._write_scratchpad(self.ctrl, self.passwd, flag)
         self._debug(1, "Verifying")
         sp = self._read_scratchpad(4)
-        self._debug(2, "SP Contains: {}".format( self.bytes2string(sp) ))
+        self._debug(2, "SP Contains: {}", self.bytes2string(sp))
         if list(sp) != list([ self.ctrl, self.passwd, 0x10, flag ]):
             raise Exception("Scratch Pad differs")
 
@@ -247,5 +631,88 @@ class Ds1977(W1ftdi):
         self._debug(1, "Copying CTRL flag to Register")
         self.copy_scratchpad(self.ctrl, self.passwd, 0x10, bytearray(password) )
 
-        
 
+# The user memory of a Ds1977 as a file, reading with password, and writing
+# with write_password (or password if it's None), the full access password:
+#
+#   f = ds.memory("password")
+#   f.seek(128)
+#   header = bytearray(16)
+#   f.readinto(header)
+#
+# Reads only fetch the pages they cover, through the cache if it's enabled,
+# and each page is copied straight into the caller's buffer. Writes go
+# through Ds1977.write_memory().
+class Ds1977file(io.RawIOBase):
+
+    def __init__(self, ds, password, write_password=None):
+        super(Ds1977file, self).__init__()
+        self.ds = ds
+        self.password = password
+        self.write_password = write_password if write_password is not None else password
+        self.size = ds._last_byte + 1
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._pos = offset
+        return self._pos
+
+    # Read into b, a bytearray or memoryview, returns the number of bytes read
+    def readinto(self, b):
+        view = memoryview(b)
+        end = min(self._pos + len(view), self.size)
+        if end <= self._pos:
+            return 0
+        first = self._pos // 64
+        count = (end - 1) // 64 - first + 1
+        ds = self.ds
+        if ds.cache is not None:
+            pages = enumerate(ds._cache_read(first, count, self.password), first)
+        elif self._pos % 64 == 0 and end % 64 == 0:
+            # Whole pages, dump() can fill the caller's buffer itself
+            for page, data in ds.dump(self.password, first, count, buffer=view[:end - self._pos]):
+                pass
+            pages = []
+        else:
+            pages = ds.dump(self.password, first, count)
+        for page, data in pages:
+            start = max(self._pos, page * 64)
+            stop = min(end, (page + 1) * 64)
+            view[start - self._pos:stop - self._pos] = memoryview(data)[start - page * 64:stop - page * 64]
+        read = end - self._pos
+        self._pos = end
+        return read
+
+    # Write b at the current position, returns the number of bytes written
+    def write(self, b):
+        data = bytearray(b)
+        if not data:
+            return 0
+        self.ds.write_memory(self._pos, data, self.write_password)
+        self._pos += len(data)
+        return len(data)
+
+    # Write back the cache, if the Ds1977 has one
+    def flush(self):
+        super(Ds1977file, self).flush()
+        self.ds.flush_cache()
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# https://www.maximintegrated.com/en/app-notes/index.mvp/id/126
+#
+# Read a DS18B20 on one pin while polling every sensor on another, using one
+# asyncio (trollius) event loop. Each pin is on a different FT232H board, only
+# one W1ftdi can have a board open at a time.
+
+import sys
+import time
+sys.path.append("..")
+
+from ds18b20 import Ds18b20
+from w1async import AsyncDs18b20, asyncio, From
+
+debug = 0  # debug level 0 to 5
+pin   = 8  # pin c0
+boards = [0, 1]  # first and second FT232H, or their serial numbers
+rate  = 5  # seconds between samples
+
+def report(timestamp, temps):
+    print time.strftime("%H:%M:%S"), temps
+
+@asyncio.coroutine
+def main(loop):
+    single = AsyncDs18b20(Ds18b20(pin, debug, device=boards[0]), loop)
+    many = AsyncDs18b20(Ds18b20(pin, debug, device=boards[1]), loop)
+    temp, temps = yield From(asyncio.gather(single.get_temp(), many.get_temps(), loop=loop))
+    print "Single: {} C, Many: {}".format(temp, temps)
+    try:
+        yield From(many.poll(report, rate=rate, count=3))
+    finally:
+        yield From(single.close())
+        yield From(many.close())
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main(loop))
+loop.close()
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# Dump the memory of a DS1977 iButton to a file, a page at a time as it's
+# read. If the dump fails part way, it carries on from the page it got to.
+
+import sys
+sys.path.append("..")
+
+from w1ftdi import W1ftdi
+from ds1977 import Ds1977
+
+debug = 0  # debug level 0 to 5
+pin   = 8  # pin c0
+password = "qwertyui"
+output = "ibutton.bin"
+attempts = 3
+
+w1 = W1ftdi(pin, debug, overdrive=True)
+w1.open()
+w1.sync()
+w1.setup_clock()
+roms = []
+if w1.reset():
+    w1.skip_rom_od()
+    roms = w1.search_roms(family=Ds1977.FAMILY)
+w1.close()
+
+if not roms:
+    raise Exception("No DS1977 found")
+
+ds = Ds1977(pin, debug, roms[0])
+page = 0
+with open(output, "wb") as f:
+    while True:
+        try:
+            for page, data in ds.dump(password, page):
+                f.write(data)
+            break
+        except Exception as e:
+            attempts -= 1
+            page = ds.last_dump["next_page"]
+            print "Dump failed at page {}: {}".format(page, e)
+            if attempts == 0:
+                raise
+    print "Dumped {} bytes from {} to {}, {:.0f} bytes/s".format(
+        f.tell(), roms[0], output, ds.last_dump["bytes_per_second"])
+ds.close()
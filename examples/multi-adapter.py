@@ -0,0 +1,30 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# Sample the DS18B20s on every attached FT232H in parallel, every 5s, and
+# print the merged results as they arrive.
+
+import sys
+import time
+sys.path.append("..")
+
+from w1ftdi import find_adapters
+from w1manager import W1manager
+from ds18b20 import Ds18b20
+
+debug = 0  # debug level 0 to 5
+pin   = 8  # pin c0 on each board
+rate  = 5  # seconds between samples
+
+for index, serial, description in find_adapters():
+    print "Adapter {}: {} ({})".format(index, serial, description)
+
+manager = W1manager(lambda device: Ds18b20(pin, debug, device=device), debug=debug)
+manager.start(lambda ds: ds.get_temps(), rate)
+try:
+    for device, timestamp, temps in manager.stream():
+        print time.strftime("%H:%M:%S", time.localtime(timestamp)), device, temps
+except KeyboardInterrupt:
+    pass
+manager.stop()
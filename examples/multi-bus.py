@@ -0,0 +1,26 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# https://www.maximintegrated.com/en/app-notes/index.mvp/id/126
+#
+# Read the DS18B20s on four buses (pins c0-c3) of one FT232H. The buses are
+# driven in lock-step, so they convert and are read together.
+
+import sys
+sys.path.append("..")
+
+from ds18b20 import Ds18b20multi
+
+debug = 0  # debug level 0 to 5
+pins  = [8, 9, 10, 11]  # pins c0, c1, c2, c3
+
+ds = Ds18b20multi(pins, debug)
+roms = ds.search_roms_all()
+for pin, bus in zip(pins, roms):
+    print "Pin {}: found {} DS18B20s".format(pin, len(bus))
+
+for pin, temps in zip(pins, ds.get_temps(roms)):
+    for rom in sorted(temps):
+        print "Pin {}: {}: {} C".format(pin, rom, temps[rom])
+ds.close()
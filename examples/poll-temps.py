@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# https://www.maximintegrated.com/en/app-notes/index.mvp/id/126
+# https://www.maximintegrated.com/en/app-notes/index.mvp/id/187
+#
+# Sample every (externally powered) DS18B20 on the bus together, every 5s.
+
+import sys
+import time
+sys.path.append("..")
+
+from ds18b20 import Ds18b20
+
+debug = 0  # debug level 0 to 5
+pin   = 8  # pin c0
+rate  = 5  # seconds between samples
+
+def report(timestamp, temps):
+    print time.strftime("%H:%M:%S", time.localtime(timestamp))
+    for rom in sorted(temps):
+        print "  {}: {} C".format(rom, temps[rom])
+
+ds = Ds18b20(pin, debug)
+roms = ds.search_roms(family=Ds18b20.FAMILY)
+print "Found DS18B20 roms: {}".format(roms)
+try:
+    ds.poll(report, roms, rate)
+except KeyboardInterrupt:
+    pass
+ds.close()
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+#
+# Several threads sharing one adapter through the W1scheduler. Each thread
+# asks for every sensor's temperature, the scheduler coalesces the requests
+# which arrive within a second of each other, so the bus only sees one per
+# second.
+
+import sys
+import threading
+import time
+sys.path.append("..")
+
+from ds18b20 import Ds18b20
+from w1scheduler import W1scheduler
+
+debug = 0  # debug level 0 to 5
+pin   = 8  # pin c0
+threads = 4
+
+ds = Ds18b20(pin, debug)
+roms = ds.search_roms(family=Ds18b20.FAMILY)
+scheduler = W1scheduler(ds, ttl=1.0, debug=debug)
+
+def reader(name):
+    for i in range(5):
+        temps = scheduler.submit(Ds18b20.get_temps, roms, key="temps").result()
+        print "{}: {}".format(name, temps)
+        time.sleep(0.5)
+
+workers = [ threading.Thread(target=reader, args=("Thread {}".format(i),)) for i in range(threads) ]
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+print "Ran {}, coalesced {}".format(scheduler.executed, scheduler.coalesced)
+scheduler.close()
@@ -25,8 +25,8 @@ w1.setup_clock()
 roms = None
 if w1.reset():
     w1.skip_rom_od()
-    roms = w1.search_roms()
-    print "Found roms: {}".format(roms)
+    roms = w1.search_roms(family=Ds1977.FAMILY)
+    print "Found DS1977 roms: {}".format(roms)
 w1.close()
 print "TEST 1: Complete"
 
@@ -35,51 +35,44 @@ if roms is None:
 
 print "TEST 2: Read Version, change passwords"
 for rom in roms:
-    if rom[0:2] == "37":
-        print "ROM {} is a DS1977, reading Version".format(rom)
-        ds = Ds1977(pin, debug, rom, pullup=pullup)
-        print "Version: {:d}".format( ds.get_version() )
-        ds.change_passwords("QWERTYUI","qwertyui","qwertyui")
-        #ds.enable_passwords(False, "qwertyui")
-        ds.close()
-    else:
-        print "ROM {} is NOT a DS1977, Skipping.".format(rom)
+    print "ROM {} is a DS1977, reading Version".format(rom)
+    ds = Ds1977(pin, debug, rom, pullup=pullup)
+    print "Version: {:d}".format( ds.get_version() )
+    ds.change_passwords("QWERTYUI","qwertyui","qwertyui")
+    #ds.enable_passwords(False, "qwertyui")
+    ds.close()
 print "TEST 2: Complete"
 
 print "TEST 3: Write a page"
 for rom in roms:
-    if rom[0:2] == "37":
-        print "ROM {} is a DS1977".format(rom)
-        ds = Ds1977(pin, debug, rom)
-        data = 'DEADBEEF' * 8
-        print "Writing data to SP: {}".format(data)
-        if ds.write_scratchpad(0x00,0x00,data):
-            print "Page written and verified"
-        data = ds.read_scratchpad(64)
-        print "Reading back SP: {}".format(data[3])
-        print "Copying data to EEPROM"
-        ds.copy_scratchpad(0x00, 0x00, 63, "password" )
-        ds.close()
-    else:
-        print "ROM {} is NOT a DS1977, Skipping.".format(rom)
+    print "ROM {} is a DS1977".format(rom)
+    ds = Ds1977(pin, debug, rom)
+    data = 'DEADBEEF' * 8
+    print "Writing data to SP: {}".format(data)
+    if ds.write_scratchpad(0x00,0x00,data):
+        print "Page written and verified"
+    data = ds.read_scratchpad(64)
+    print "Reading back SP: {}".format(data[3])
+    print "Copying data to EEPROM"
+    ds.copy_scratchpad(0x00, 0x00, 63, "password" )
+    ds.close()
 print "TEST 3: Complete"
 
 print "TEST 4: Read a page"
 for rom in roms:
-    if rom[0:2] == "37":
-        print "ROM {} is a DS1977".format(rom)
-        ds = Ds1977(pin, debug, rom)
-        pages = ds.read_memory(0x00, 0x00, "password", 1)
-        print "Read a single page: {}".format(pages[0])
-        pages = ds.read_memory(0x1f, 0x00, "password", 1)
-        print "Read half a page: {}".format(pages[0])
-        pages = ds.read_memory(0x00, 0x00, "password", 2)
-        print "Read two pages 1/2: {}".format(pages[0])
-        print "Read two pages 2/2: {}".format(pages[1])
-        pages = ds.read_pages(506, "password", 0)
-        for page in pages:
-            print "Page: {}".format(page)
-        ds.close()
+    print "ROM {} is a DS1977".format(rom)
+    ds = Ds1977(pin, debug, rom)
+    pages = ds.read_memory(0x00, 0x00, "password", 1)
+    print "Read a single page: {}".format(pages[0])
+    pages = ds.read_memory(0x1f, 0x00, "password", 1)
+    print "Read half a page: {}".format(pages[0])
+    pages = ds.read_memory(0x00, 0x00, "password", 2)
+    print "Read two pages 1/2: {}".format(pages[0])
+    print "Read two pages 2/2: {}".format(pages[1])
+    pages = ds.read_pages(506, "password", 0)
+    for page in pages:
+        print "Page: {}".format(page)
+    ds.close()
 print "TEST 4: Complete"
 
 
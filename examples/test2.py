@@ -21,19 +21,16 @@ w1.sync()
 w1.setup_clock()
 
 if w1.reset():
-    roms = w1.search_roms()
-    print "Found roms: {}".format(roms)
+    roms = w1.search_roms(family=Ds18b20.FAMILY)
+    print "Found DS18B20 roms: {}".format(roms)
 w1.close()
 print "TEST 1: Complete"
 
 print "TEST 2: Read Temperature"
 for rom in roms:
-    if rom[0:2] == "28":
-        print "ROM {} is a DS18B20, reading Temperature".format(rom)
-        ds = Ds18b20(pin, debug, rom)
-        celsius = ds.get_temp()
-        print "Temp {} C".format(celsius)
-        ds.close()
-    else:
-        print "ROM {} is NOT a DS18B20, Skipping.".format(rom)
+    print "ROM {} is a DS18B20, reading Temperature".format(rom)
+    ds = Ds18b20(pin, debug, rom)
+    celsius = ds.get_temp()
+    print "Temp {} C".format(celsius)
+    ds.close()
 print "TEST 2: Complete"
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# asyncio front-end for W1ftdi and the device drivers
+#
+# Wraps a W1ftdi (or Ds18b20/Ds1977) so that one event loop can drive many
+# adapters and sensors concurrently. Every blocking USB call runs on a thread
+# dedicated to the adapter, and conversion and EEPROM waits become asyncio
+# sleeps instead of blocking the caller.
+#
+# The low level calls (reset, read_bytes, write_bytes...) each run atomically,
+# but a sequence of them is only a transaction if you hold the adapter lock:
+#
+#   with (yield From(bus.lock)):
+#       yield From(bus.reset())
+#       ...
+#
+# The higher level calls (search_roms, get_temp, read_memory...) take the lock
+# themselves. This is python 2, so asyncio comes from trollius, and coroutines
+# use yield From() and raise Return().
+
+import trollius as asyncio
+from trollius import From, Return
+from concurrent.futures import ThreadPoolExecutor
+
+from ds18b20 import WAIT_POLL, CONVERSION_TIME, POLL_INTERVAL
+
+class AsyncW1ftdi(object):
+
+    def __init__(self, w1, loop=None):
+        self.w1 = w1
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.lock = asyncio.Lock(loop=self.loop)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    # Run a blocking call on the adapter's thread, returns a future
+    def run(self, func, *args):
+        return self.loop.run_in_executor(self._executor, func, *args)
+
+    # Close the adapter, and stop its thread
+    @asyncio.coroutine
+    def close(self):
+        yield From(self.run(self.w1.close))
+        self._executor.shutdown()
+
+    def reset(self):
+        return self.run(self.w1.reset)
+
+    def address_rom(self, rom):
+        return self.run(self.w1.address_rom, rom)
+
+    def write_byte(self, byte):
+        return self.run(self.w1.write_byte, byte)
+
+    def write_bytes(self, data):
+        return self.run(self.w1.write_bytes, data)
+
+    def read_byte(self):
+        return self.run(self.w1.read_byte)
+
+    def read_bytes(self, count):
+        return self.run(self.w1.read_bytes, count)
+
+    # The asyncio version of W1ftdi.pullup_and_check(), the command buffer must
+    # already be enabled.
+    @asyncio.coroutine
+    def pullup_and_check(self, ms=10):
+        down = yield From(self.run(self.w1._pullup_start, ms))
+        yield From(asyncio.sleep(self.w1._pullup_seconds(ms), loop=self.loop))
+        byte = yield From(self.run(self.w1._pullup_finish, down))
+        raise Return(byte)
+
+    @asyncio.coroutine
+    def search_roms(self, family=None):
+        with (yield From(self.lock)):
+            roms = yield From(self.run(self.w1.search_roms, family))
+        raise Return(roms)
+
+    @asyncio.coroutine
+    def read_each(self, roms, command, count):
+        with (yield From(self.lock)):
+            data = yield From(self.run(self.w1.read_each, roms, command, count))
+        raise Return(data)
+
+class AsyncDs18b20(AsyncW1ftdi):
+
+    # Read Temperature, from rom or the Ds18b20's own ROM
+    @asyncio.coroutine
+    def get_temp(self, rom=None):
+        ds = self.w1
+        if rom is None:
+            rom = ds.rom
+        with (yield From(self.lock)):
+            wait = yield From(self.run(ds._start_conversion, rom))
+            yield From(self._wait_conversion(wait, ds._resolutions.get(rom, 3)))
+            temp = yield From(self.run(ds._read_temp, rom))
+        raise Return(temp)
+
+    # Read the temperature from many sensors, see Ds18b20.get_temps()
+    @asyncio.coroutine
+    def get_temps(self, roms=None):
+        ds = self.w1
+        with (yield From(self.lock)):
+            if roms is None:
+                roms = yield From(self.run(ds.search_roms, ds.FAMILY))
+            wait = yield From(self.run(ds.convert_all))
+            yield From(self._wait_conversion(wait, ds._max_resolution(roms)))
+            temps = yield From(self.run(ds.read_temps, roms))
+        raise Return(temps)
+
+    # Continuously sample the sensors every rate seconds, calling
+    # callback(timestamp, temps) with each sample.
+    @asyncio.coroutine
+    def poll(self, callback, roms=None, rate=1.0, count=None):
+        samples = 0
+        due = self.loop.time()
+        while count is None or samples < count:
+            temps = yield From(self.get_temps(roms))
+            callback(self.loop.time(), temps)
+            samples += 1
+            due += rate
+            yield From(asyncio.sleep(max(0, due - self.loop.time()), loop=self.loop))
+
+    # The asyncio version of Ds18b20._wait_conversion()
+    @asyncio.coroutine
+    def _wait_conversion(self, wait, resolution):
+        ds = self.w1
+        if wait == WAIT_POLL:
+            while True:
+                poll = yield From(self.run(ds.read_byte))
+                if ds._conversion_done(poll):
+                    break
+                yield From(asyncio.sleep(POLL_INTERVAL, loop=self.loop))
+        else:
+            yield From(asyncio.sleep(CONVERSION_TIME[resolution], loop=self.loop))
+            ds._conversion_done()
+
+class AsyncDs1977(AsyncW1ftdi):
+
+    # See Ds1977.read_memory()
+    @asyncio.coroutine
+    def read_memory(self, ta1, ta2, password, pages=1):
+        ds = self.w1
+        responses = []
+        with (yield From(self.lock)):
+            pages, length = yield From(self.run(ds._start_read_memory, ta1, ta2, password, pages))
+            for i in xrange(pages):
+                yield From(self.run(ds.enable_command_buffer))
+                first = yield From(self.pullup_and_check(5))
+                response = yield From(self.run(ds._read_page, ta1, ta2, i, first, length))
+                responses.append(response)
+                length = ds._page_length
+            yield From(self.run(ds.reset))
+        raise Return(responses)
+
+    # See Ds1977.read_pages()
+    @asyncio.coroutine
+    def read_pages(self, start, password, number=1):
+        pages = self.w1._pages - (start+number)
+        if pages < 0 or pages > self.w1._pages:
+            raise Exception("DS1977 has 511 (0-510) user addressable pages")
+        start = start * 64
+        responses = yield From(self.read_memory(start&0xff, start>>8, password, number))
+        raise Return(responses)
+
+    @asyncio.coroutine
+    def get_version(self):
+        with (yield From(self.lock)):
+            version = yield From(self.run(self.w1.get_version))
+        raise Return(version)
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Page cache for 1-wire memory devices, see Ds1977.enable_cache()
+#
+# Pages are kept per ROM, up to capacity pages in all, and the least recently
+# used page is evicted to make room. Written pages are marked dirty, and kept
+# with the password needed to write them back. The cache doesn't talk to the
+# device itself, evicted dirty pages are handed back to the driver to write.
+
+import collections
+
+CAPACITY = 64         # Pages kept, 4KB of DS1977 memory
+
+# A cached page
+class _Page(object):
+
+    __slots__ = ("data", "dirty", "password")
+
+    def __init__(self, data, dirty, password):
+        self.data = data
+        self.dirty = dirty
+        self.password = password
+
+class W1pagecache(object):
+
+    def __init__(self, capacity=CAPACITY):
+        if capacity < 1:
+            raise Exception("The cache must hold at least one page")
+        self.capacity = capacity
+        self._pages = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._pages)
+
+    # The data of page on rom, or None if it isn't cached
+    def get(self, rom, page):
+        entry = self._pages.pop((rom, page), None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._pages[(rom, page)] = entry
+        self.hits += 1
+        return entry.data
+
+    # Cache data for page on rom, dirty if it still has to be written back
+    # with password. Returns a list of (rom, page, data, password) for the
+    # dirty pages evicted to make room.
+    def put(self, rom, page, data, dirty=False, password=None):
+        key = (rom, page)
+        entry = self._pages.pop(key, None)
+        if entry is not None and entry.dirty and not dirty:
+            # Keep the unwritten data over what was read from the device
+            self._pages[key] = entry
+            return []
+        self._pages[key] = _Page(bytearray(data), dirty, password)
+        evicted = []
+        while len(self._pages) > self.capacity:
+            (old_rom, old_page), old = self._pages.popitem(last=False)
+            self.evictions += 1
+            if old.dirty:
+                evicted.append((old_rom, old_page, old.data, old.password))
+        return evicted
+
+    # The dirty pages, for rom or all ROMs if None, as a list of (rom, page,
+    # data, password) in ROM and page order
+    def dirty(self, rom=None):
+        return sorted((key[0], key[1], entry.data, entry.password)
+                      for key, entry in self._pages.items()
+                      if entry.dirty and (rom is None or key[0] == rom))
+
+    # Mark page on rom as written back, if it still holds data
+    def clean(self, rom, page, data):
+        entry = self._pages.get((rom, page))
+        if entry is not None and entry.data == data:
+            entry.dirty = False
+            entry.password = None
+
+    # Drop the clean pages for rom (or all ROMs if None), when the device may
+    # have been changed behind our back. Dirty pages are kept to be written.
+    def invalidate(self, rom=None):
+        for key, entry in self._pages.items():
+            if not entry.dirty and (rom is None or key[0] == rom):
+                del self._pages[key]
+                self.invalidations += 1
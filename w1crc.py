@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Dallas/Maxim CRC8 and CRC16, table driven.
+#
+# https://www.maximintegrated.com/en/app-notes/index.mvp/id/27
+#
+# A CRC run over data followed by its own CRC returns 0x00. Devices such as
+# the DS1977 send the inverse of their CRC16, use Crc.update_inverted() to feed
+# those bytes.
+
+CRC8_POLY = 0x8c      # x8,x5,x4,+ 1 inverse of 0x131 & 0xff
+CRC16_POLY = 0xa001   # x16, x15, x2, +1
+
+# Build the 256 entry table for the (reflected) polynomial, each entry is the
+# CRC register after shifting a byte through it.
+def _build_table(poly):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            if crc & 0x01:
+                crc = (crc >> 1) ^ poly
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+CRC8_TABLE = _build_table(CRC8_POLY)
+CRC16_TABLE = _build_table(CRC16_POLY)
+
+# Calculate the CRC8 of data, continuing from crc
+def crc8(data, crc=0x00):
+    if type(data) is str:
+        data = bytearray( data )
+    table = CRC8_TABLE
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
+# Calculate the CRC16 of data, continuing from crc
+def crc16(data, crc=0x0000):
+    if type(data) is str:
+        data = bytearray( data )
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+# Check many buffers, each ending with its CRC. Returns a list of booleans,
+# True for each buffer which passed.
+def verify_many(buffers, bits=8):
+    if bits == 8:
+        func = crc8
+    elif bits == 16:
+        func = crc16
+    else:
+        raise Exception("Unsupported CRC length")
+    return [ func(data) == 0x00 for data in buffers ]
+
+# Incremental CRC, feed it data as it arrives from the bus.
+class Crc(object):
+
+    def __init__(self, bits=8, crc=0x00):
+        if bits == 8:
+            self._func = crc8
+        elif bits == 16:
+            self._func = crc16
+        else:
+            raise Exception("Unsupported CRC length")
+        self.bits = bits
+        self.crc = crc
+
+    # Add data to the CRC
+    def update(self, data):
+        self.crc = self._func(data, self.crc)
+        return self
+
+    # Add data which the device sent inverted, ie its CRC16
+    def update_inverted(self, data):
+        self.crc = self._func(bytearray(b ^ 0xff for b in bytearray(data)), self.crc)
+        return self
+
+    # Once the device CRC has been fed in, the result should be 0x00
+    def valid(self):
+        return self.crc == 0x00
@@ -11,19 +11,37 @@ import os
 import time
 import ftdi1 as ftdi
 import math
-import struct
 import codecs
+import collections
+import contextlib
+from w1crc import crc8, crc16
+from w1registry import W1registry
+from w1stats import W1stats
+import w1trace
+from w1trace import W1trace, TRACE_WRITE, TRACE_READ
 
 FT232H_VID = 0x0403   # Default FTDI FT232H vendor ID
 FT232H_PID = 0x6014   # Default FTDI FT232H product ID
+FT232H_RX_FIFO = 1024 # FT232H receive buffer (bytes waiting for the host)
 DEBUG = 0             # level 0 to 5
 OVERDRIVE = False     # Should Overdrive be used?
+LATENCY = 16          # USB latency timer (ms)
+READ_BACKOFF = 0.0001 # First sleep when polling for a response (seconds)
+READ_BACKOFF_MAX = 0.005 # Longest sleep when polling for a response (seconds)
+STREAM_WINDOW = FT232H_RX_FIFO // 2 # Response bytes per window when streaming
+HARDWARE_WAIT = True  # Have the MPSSE time pullup_and_check() waits, not the host
 
 class W1ftdi(object):
 
-    def __init__(self, pin, debug=DEBUG, overdrive=OVERDRIVE, pullup=None):
+    # The operations recorded by enable_stats()
+    _instrumented = ("sync", "reset", "address_rom", "resume", "write_bit", "write_byte",
+                     "write_bytes", "read_bit", "read_byte", "read_bytes", "read_each",
+                     "pullup_and_check", "search_roms", "verify_roms", "refresh_roms")
+
+    def __init__(self, pin, debug=DEBUG, overdrive=OVERDRIVE, pullup=None, latency=LATENCY, device=None):
         self._rmmod()
         self._dbg = debug
+        self.device = device
         self._ctx = ftdi.new()
         self._level = 0x0000
         self._direction = 0x0000
@@ -35,10 +53,24 @@ class W1ftdi(object):
         self._od = False
         self._rc = False
         self._gpiol1 = 5
+        self._write_tables = {}
+        self._write_table = None
+        self._slots = None
+        self.low = None
+        self.high = None
+        self.latency = latency
+        self.sleeps = 0
+        self.last_sleeps = 0
+        self.round_trips = 0
+        self.stats = None
+        self._trace = None
+        if debug:
+            w1trace.default_handler()
 
         # Set the pin to use
         self.pin = pin
         self.pullup = pullup
+        self._build_read_tables()
 
         # Set up delay timers (clock frequencies)
         self._reset_clocks(False)
@@ -50,9 +82,19 @@ class W1ftdi(object):
         self.pb          = '\x8e\x01'      # Pulse clock (1 bits) 
         self.delay       = self.pb
 
+        # Long waits are done by the MPSSE clocking out 1us pulses, 8 at a
+        # time, see _wait_commands()
+        self.clock_W     = str(self._get_delay_cmd(0.000002))
+        self.hardware_wait = HARDWARE_WAIT
+
         # MPSSE Command to read GPIO
         self.read_gpio   = '\x81\x83'
 
+        # MPSSE Command to send the read buffer back to the host now, rather
+        # than waiting for the latency timer. Ends every command which expects
+        # a response.
+        self.send_immediate = '\x87'
+
         # If we have a pullup pin, set it to low by default, this pin controls
         # switching on a strong_pullup if the device needs extra power. It is
         # activated when pullup_and_check() is called.
@@ -69,10 +111,96 @@ class W1ftdi(object):
             raise Exception("Failed to open FTDI")
         atexit.register(self.close)
 
-    # Debug function
-    def _debug(self, level, msg):
+    # Debug function, msg is formatted with args only if it's logged. Calls in
+    # the hot path should check self._dbg first, to save the call.
+    def _debug(self, level, msg, *args):
         if self._dbg >= level:
-            print "DEBUG {} {:.9f}, {}".format(level, time.time(), msg)
+            w1trace.log(level, msg, args)
+
+    # Record the USB traffic to a binary trace, a W1trace or a file path.
+    # Returns the W1trace.
+    def enable_trace(self, trace):
+        if not isinstance(trace, W1trace):
+            trace = W1trace(trace)
+        self._trace = trace
+        return trace
+
+    # Stop tracing, and close the trace
+    def disable_trace(self):
+        if self._trace is not None:
+            self._trace.close()
+        self._trace = None
+
+    # Start recording statistics for each 1-wire operation into stats (a new
+    # W1stats if not given), and return it. The instrumented methods are
+    # wrapped on this instance only, so there is no cost when disabled.
+    def enable_stats(self, stats=None):
+        if self.stats is not None:
+            self.disable_stats()
+        self.stats = stats if stats is not None else W1stats()
+        for name in self._instrumented:
+            self._instrument(name)
+        self._instrument_usb()
+        return self.stats
+
+    # Stop recording statistics, returns the W1stats
+    def disable_stats(self):
+        stats = self.stats
+        for name in self._instrumented + ("_write", "_read", "flush_command_buffer"):
+            self.__dict__.pop(name, None)
+        self.stats = None
+        return stats
+
+    # Wrap the operation name so that stats records each call
+    def _instrument(self, name):
+        method = getattr(self, name)
+        stats = self.stats
+        def instrumented(*args, **kwargs):
+            stats.begin(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats.end()
+        setattr(self, name, instrumented)
+
+    # Wrap the USB reads and writes, and the buffer flush, so that stats sees
+    # the traffic. Time spent sleeping while polling for a read is not counted
+    # as USB time.
+    def _instrument_usb(self):
+        stats = self.stats
+        write = self._write
+        read = self._read
+        flush = self.flush_command_buffer
+        def _write(string):
+            if self._buffer:
+                return write(string)
+            start = time.time()
+            write(string)
+            stats.usb_write(len(string), time.time() - start)
+        def _read(length, timeout=5):
+            slept = stats.totals["sleep_seconds"]
+            start = time.time()
+            response = read(length, timeout)
+            stats.usb_read(length, time.time() - start - (stats.totals["sleep_seconds"] - slept))
+            return response
+        def flush_command_buffer():
+            if self._output is not None:
+                stats.flushed(len(self._output))
+            flush()
+        self._write = _write
+        self._read = _read
+        self.flush_command_buffer = flush_command_buffer
+
+    # Sleep, recording the time in stats if enabled
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+        if self.stats is not None:
+            self.stats.slept(seconds)
+
+    # Record a CRC failure, for rom if known
+    def _crc_failure(self, rom=None):
+        if self.stats is not None:
+            self.stats.crc_failure(rom)
 
     # Remove the kernels FTDI Serial modules
     def _rmmod(self):
@@ -86,7 +214,7 @@ class W1ftdi(object):
             clock_hz = 30000000.0
         else:
             clock_hz = ( 1.00 / seconds ) * 2
-        self._debug(3, "Delay: {:0.7f}, Freq: {}".format(seconds, clock_hz))
+        self._debug(3, "Delay: {:0.7f}, Freq: {}", seconds, clock_hz)
 
         divisor = int(math.ceil((30000000.0-float(clock_hz))/float(clock_hz))) & 0xFFFF
         valueH = ( divisor >> 8 ) & 0xFF
@@ -128,50 +256,135 @@ class W1ftdi(object):
             self.clock_J = self._get_delay_cmd(0.000410)
             self.clock_Z = self._get_delay_cmd(0.000000)
 
-    # Buffer write commands and then send them to the MPSSE with a flush
+        # Switch to the byte table for this speed, if we've built one already
+        self._write_table, self._slots = self._write_tables.get(self._od, (None, None))
+
+    # Build the 256 entry table of complete MPSSE command sequences needed to
+    # write each byte at the current speed, along with the single slots (write
+    # 0, write 1, read). Tables are cached per speed, and thrown away by
+    # set_pin() when the GPIO state changes.
+    def _build_write_table(self):
+        self._debug(3, "1Wire: Building byte table, Overdrive: {}", self._od)
+        one = str(self.clock_A + self.low + self.delay + self.high + self.clock_B + self.delay)
+        zero = str(self.clock_C + self.low + self.delay + self.high + self.clock_D + self.delay)
+        read = str(self.clock_A + self.low + self.delay + self.high + self.clock_E +
+                   self.delay + self.read_gpio + self.clock_F + self.delay)
+        table = []
+        for byte in range(256):
+            table.append("".join(one if (byte >> i) & 1 else zero for i in range(8)))
+        self._write_table = table
+        self._slots = (zero, one, read)
+        self._write_tables[self._od] = (table, self._slots)
+        return table
+
+    # Return the (write 0, write 1, read) slot commands for the current speed
+    def _get_slots(self):
+        if self._slots is None:
+            self._build_write_table()
+        return self._slots
+
+    # Build the translation tables used to decode read slots. Each slot returns
+    # the low and high GPIO bytes, so we pick the byte holding our pin, and
+    # translate it straight to the bit value.
+    def _build_read_tables(self):
+        self._sample_offset = self.pin >> 3
+        shift = self.pin & 0x07
+        self._sample_table = "".join(chr((b >> shift) & 0x01) for b in range(256))
+        self._pack_table = dict((str(bytearray((b >> i) & 0x01 for i in range(8))), b) for b in range(256))
+
+    # Buffer write commands and then send them to the MPSSE with a flush. The
+    # commands are appended to a bytearray, which grows in place, so building
+    # a large buffer takes linear time.
     def enable_command_buffer(self):
         if self._buffer:
             raise Exception("Buffering was already enabled!!")
         self._buffer = True
-        self._output = None
+        self._output = bytearray()
 
-    # flush buffered commands to the MPSSE
+    # flush buffered commands to the MPSSE, in a single write
     def flush_command_buffer(self):
         self._buffer = False
-        if self._output is not None:
-            if len(self._output) > self._max_buffer:
-                self._max_buffer = len(self._output)
-            self._write(self._output)
-            self._output = None
-        
+        output = self._output
+        self._output = None
+        if output:
+            if len(output) > self._max_buffer:
+                self._max_buffer = len(output)
+            self._write(str(output))
+
+    # Drop the buffered commands without sending them
+    def discard_command_buffer(self):
+        self._buffer = False
+        self._output = None
+
+    # Buffer the commands written in a with block, and flush them at the end:
+    #
+    #   with w1.command_buffer():
+    #       w1.reset()
+    #       w1.write_bytes(data)
+    #
+    # If buffering is already enabled, the commands join that buffer and are
+    # flushed with it, so these can be nested. If the block raises, the
+    # commands buffered since buffering was enabled are dropped.
+    @contextlib.contextmanager
+    def command_buffer(self):
+        if self._buffer:
+            yield
+            return
+        self.enable_command_buffer()
+        try:
+            yield
+        except:
+            self.discard_command_buffer()
+            raise
+        if self._buffer:
+            self.flush_command_buffer()
+
     # Write data to the FTDI MPSSE engine
     def _write(self, string):
-        length = len(string)
         if self._buffer:
-            if self._output is None:
-                self._output = string
-            else:
-                self._output += string
-            self._debug(5, "MPSSE: Buffering: " + "".join("{:02x}".format(ord(c)) for c in self._output))
+            self._output += string
+            if self._dbg >= 5:
+                self._debug(5, "MPSSE: Buffering: {}", codecs.encode(str(string), "hex"))
             return
-        self._debug(5, "MPSSE: Write: " + "".join("{:02x}".format(ord(c)) for c in string))
+        length = len(string)
+        if self._dbg >= 5:
+            self._debug(5, "MPSSE: Write: {}", codecs.encode(string, "hex"))
+        if self._trace is not None:
+            self._trace.record(TRACE_WRITE, string)
         ftdi.write_data(self._ctx, string, length)
 
-    # Read data from the FTDI MPSSE engine
+    # Read data from the FTDI MPSSE engine. Commands expecting a response end
+    # with send_immediate, so we poll for it, backing off from READ_BACKOFF to
+    # READ_BACKOFF_MAX while nothing has arrived. The number of sleeps taken is
+    # kept in last_sleeps, and totalled in sleeps.
     def _read(self, length, timeout=5):
         start = time.time()
         response = bytearray(length)
         count = 0
+        sleeps = 0
+        backoff = READ_BACKOFF
+        self.round_trips += 1
         while count < length:
             if ( time.time() - start >= timeout ):
+                self.last_sleeps = sleeps
+                self.sleeps += sleeps
                 raise Exception("FTDI Read Timeout")
             read, data = ftdi.read_data(self._ctx, length - count)
             if read < 0:
                 raise Exception("USB Error: {}".format(read))
-            response[count:read] = data[:read]
-            count += read
-            time.sleep(0.01)
-        self._debug(5, "MPSSE: Read: " + "".join("{:02x}".format(c) for c in response))
+            if read > 0:
+                response[count:count+read] = data[:read]
+                count += read
+                continue
+            self._sleep(backoff)
+            sleeps += 1
+            backoff = min(backoff * 2, READ_BACKOFF_MAX)
+        self.last_sleeps = sleeps
+        self.sleeps += sleeps
+        if self._dbg >= 5:
+            self._debug(5, "MPSSE: Read: {}", codecs.encode(str(response), "hex"))
+        if self._trace is not None:
+            self._trace.record(TRACE_READ, response)
         return response
 
     # Flush bytes in the MPSSE read buffer
@@ -186,8 +399,10 @@ class W1ftdi(object):
 
     # Open the FTDI and prepare the MPSSE engine for use.
     def open(self, usb_reset=True):
-        self._debug(3, "MPSSE: Open")
-        ftdi.usb_open(self._ctx, FT232H_VID, FT232H_PID)
+        self._debug(3, "MPSSE: Open {}", self.device)
+        ret = self._usb_open(self.device)
+        if ret < 0:
+            raise Exception("Failed to open FTDI device {}: {}".format(self.device, ret))
         if usb_reset:
             ftdi.usb_reset(self._ctx)
         ftdi.read_data_set_chunksize(self._ctx, 65535)
@@ -196,13 +411,38 @@ class W1ftdi(object):
         ftdi.set_bitmode(self._ctx, 0, 0)
         # Enable MPSSE
         ftdi.set_bitmode(self._ctx, 0, 2)
-        # Set Latency timer to 16ms
-        ftdi.set_latency_timer(self._ctx, 16)
+        # Set the Latency timer
+        self.set_latency(self.latency)
+
+    # Open the FT232H selected by device. Which is one of:
+    #   None                 - the first FT232H found
+    #   int                  - the nth FT232H found, see find_adapters()
+    #   "d:<bus>/<device>"   - a USB bus/device path, eg "d:001/004"
+    #   "i:..." or "s:..."   - any other libftdi device string
+    #   str                  - the FT232H with this serial number
+    def _usb_open(self, device):
+        if device is None:
+            return ftdi.usb_open(self._ctx, FT232H_VID, FT232H_PID)
+        if type(device) is int:
+            return ftdi.usb_open_desc_index(self._ctx, FT232H_VID, FT232H_PID, None, None, device)
+        if device[:2] in ("d:", "i:", "s:"):
+            return ftdi.usb_open_string(self._ctx, device)
+        return ftdi.usb_open_desc_index(self._ctx, FT232H_VID, FT232H_PID, None, device, 0)
+
+    # Set the USB latency timer (ms). The FT232H sends any waiting data back to
+    # the host when it expires, if it wasn't sent immediately.
+    def set_latency(self, latency):
+        self._debug(3, "MPSSE: Latency timer: {}ms", latency)
+        self.latency = latency
+        if self._ctx is not None:
+            ftdi.set_latency_timer(self._ctx, latency)
 
     # Cleanup the FTDI connection and release it.
     def close(self):
         if self._ctx is not None:
-            self._debug(3, "MPSSE: Max buffer: {}".format(self._max_buffer))
+            self._debug(3, "MPSSE: Max buffer: {}", self._max_buffer)
+            self._debug(3, "MPSSE: Read sleeps: {}", self.sleeps)
+            self._debug(3, "MPSSE: Round trips: {}", self.round_trips)
             self._debug(3, "MPSSE: Closed. FTDI Released")
             ftdi.free(self._ctx)
         self._ctx = None
@@ -215,7 +455,7 @@ class W1ftdi(object):
         self._debug(3, "MPSSE: Sync")
         retries = 10
         tries = 0
-        self._write('\xAB')
+        self._write('\xAB' + self.send_immediate)
         sync = False
         while not sync:
             data = self._read(2)
@@ -236,7 +476,7 @@ class W1ftdi(object):
 
     # Read the GPIO state from the MPSSE Directly
     def read_gpio_state(self):
-        self._write( self.read_gpio )
+        self._write( self.read_gpio + self.send_immediate )
         state = self._read(2)
         return state
 
@@ -263,6 +503,7 @@ class W1ftdi(object):
 
         # Update the pin requested.
         self._set_pin(pin, out, high)
+        old = (self.low, self.high)
 
         # Update out MPSSE command for 1-wire low
         self._set_pin(self.pin, True, False)
@@ -272,9 +513,16 @@ class W1ftdi(object):
         self._set_pin(self.pin, False, True)
         self.high = self.get_gpio_cmd()
 
+        # The byte tables embed low and high, so they need rebuilding if
+        # either changed
+        if (self.low, self.high) != old:
+            self._write_tables = {}
+            self._write_table = None
+            self._slots = None
+
     # Set the GPIO pin to in/out and high/low
     def _set_pin(self, pin, out, high):
-        self._debug(3, "GPIO: Setting Pin: {}, Out: {}, High: {}".format(pin, out, high))
+        self._debug(3, "GPIO: Setting Pin: {}, Out: {}, High: {}", pin, out, high)
         if out:
             self._direction |= (1 << pin) & 0xFFFF
         else:
@@ -291,12 +539,11 @@ class W1ftdi(object):
     # are connected and we return false.
     def reset(self):
 
-        self._debug(2, "1Wire: Reset")
-        commands =  self.clock_G + self.high + self.delay + \
-                    self.clock_H + self.low + self.delay + self.high + self.clock_I + self.delay + \
-                    self.read_gpio + self.clock_J + self.delay + self.read_gpio 
-
-        self._write(str(commands))
+        if self._dbg >= 2:
+            self._debug(2, "1Wire: Reset")
+        if self.stats is not None:
+            self.stats.bus_reset()
+        self._write(self._reset_command() + self.send_immediate)
         present = self._read(4)
 
         if present == '\xff'*4:
@@ -311,56 +558,127 @@ class W1ftdi(object):
             self._debug(2, "1Wire: Devices Present")
             return True
 
+    # The MPSSE commands for a reset, the GPIO is read twice, once during the
+    # presence pulse, and once after it.
+    def _reset_command(self):
+        commands =  self.clock_G + self.high + self.delay + \
+                    self.clock_H + self.low + self.delay + self.high + self.clock_I + self.delay + \
+                    self.read_gpio + self.clock_J + self.delay + self.read_gpio
+        return str(commands)
+
     # A device needs to do some processing, sleep some, and then check for a
     # result. If pullup is defined, we'll ensure that pin is high while we sleep.
-    # NB: If we use pin 5 (D5 (GPIOL1)), then we use MPSSE 0x88 and 0x89 to
-    # to detect the 1/0 pulses from the slave at completion.
+    # With hardware_wait, the wait is done by the MPSSE rather than a sleep on
+    # the host, and the buffered commands, the pullup on, the wait, the pullup
+    # off and the read of the result go out in a single write.
     def pullup_and_check(self, ms=10, commands=""):
+        if self.hardware_wait:
+            return self._pullup_finish(self._pullup_queue(ms))
+        down = self._pullup_start(ms)
+        self._sleep(self._pullup_seconds(ms))
+        return self._pullup_finish(down)
+
+    # Start the pullup_and_check() wait. Flushes the buffered commands, with the
+    # pullup enabled if we have one. Returns the command to disable it again,
+    # to send once _pullup_seconds() have passed. With hardware_wait the MPSSE
+    # does the wait and disables the pullup, and there's nothing to send.
+    def _pullup_start(self, ms):
+        down = self._pullup_queue(ms)
+        self.flush_command_buffer()
+        return down
+
+    # Buffer the commands for the pullup_and_check() wait, without flushing
+    # them. Returns the command to disable the pullup, as _pullup_start().
+    def _pullup_queue(self, ms):
         if self._buffer is False:
             raise Exception("You must buffer commands when using pullup_and_check() to ensure correct timing")
-        secs = 1.0 * ms / 1000.0
-        up = None
-        down = None
+        up, down = self._pullup_commands()
+        if self.hardware_wait:
+            self._debug(2, "1Wire: Pullup Waiting in the MPSSE for {}ms", ms)
+            self._write(up + self._wait_commands(ms / 1000.0) + down)
+            return None
+        self._debug(2, "1Wire: Pullup Sleeping for {}ms", ms)
+        self._write(up)
+        return down or None
+
+    # The time the host has to wait after _pullup_start(), before the result
+    # can be read
+    def _pullup_seconds(self, ms):
+        if self.hardware_wait:
+            return 0.0
+        return ms / 1000.0
+
+    # The commands to enable and disable the pullup, or empty strings if
+    # pullup isn't defined
+    def _pullup_commands(self):
 
         # If pullup is defined, then its providing additional power, keep the
         # pin up for the duration of the work.
-        if self.pullup is not None:
-            self._debug(2, "1Wire: Pullup Enabling additional power via GPIO {}".format(self.pullup))
-            self.set_pin(self.pullup, True, True)
-            up = self.get_gpio_cmd()
-            self.set_pin(self.pullup, False, False)
-            down = self.get_gpio_cmd()
-
-        # If we're using GPIOL1 (pin 5) then we can get the MPSSE to wait for the
-        # slave to signal completion, if not we just have to sleep.
-        #if self.pin is self._gpiol1:
-        #   wait_signal = self.clock_Z + bytearray( (0x88, 0x89) )
-        #   commands = wait_signal
-        #   if up is not None:
-        #       commands = up + wait_signal + down
-        #   self.flush_command_buffer()
-        #   self._debug(2, "1Wire: Pullup Waiting for Signal")
-        #   self._write( str( commands ) )
-        #else:
-
-        self._debug(2, "1Wire: Pullup Sleeping for {}ms".format(ms))
-        if up is not None:
-            self._write(str(up))
-            self.flush_command_buffer()
-            time.sleep( secs )
+        if self.pullup is None:
+            return ("", "")
+        self._debug(2, "1Wire: Pullup Enabling additional power via GPIO {}", self.pullup)
+
+        # Build the commands without going through set_pin(), the GPIO ends
+        # up as it started so low, high and the byte tables stay valid.
+        level, direction = self._level, self._direction
+        self._set_pin(self.pullup, True, True)
+        up = self.get_gpio_cmd()
+        self._set_pin(self.pullup, False, False)
+        down = self.get_gpio_cmd()
+        self._level, self._direction = level, direction
+        return (str(up), str(down))
+
+    # The MPSSE commands to wait for seconds, by clocking out 1us pulses. If
+    # we're on GPIOL1 (pin 5), the MPSSE then waits for the line to be high,
+    # so a slave still holding it low has finished before the next slot.
+    def _wait_commands(self, seconds):
+        blocks = int(math.ceil(seconds * 1000000.0 / 8))
+        commands = [ self.clock_W ]
+        while blocks > 0:
+            count = min(blocks, 0x10000)
+            commands.append(str(bytearray((0x8f, (count - 1) & 0xff, (count - 1) >> 8))))
+            blocks -= count
+        if self.pin == self._gpiol1:
+            commands.append("\x88")
+        return "".join(commands)
+
+    # Finish the pullup_and_check() wait, once the time is up
+    def _pullup_finish(self, down):
+        if down is not None:
             self._write(str(down))
-        else:
-            self.flush_command_buffer()
-            time.sleep( secs )
 
-        # Check for a response from the slave
-        byte = self.read_byte()
-        self._debug(2, "1Wire: Pullup Complete, Returning First Byte: {:x}".format(byte))
+        # Check for a response from the slave. On GPIOL1 the MPSSE waits for
+        # the line to go high first, with no timeout, so if it never does the
+        # MPSSE is stuck and the read times out.
+        try:
+            byte = self.read_byte()
+        except Exception as e:
+            if not (self.hardware_wait and self.pin == self._gpiol1):
+                raise
+            self._debug(1, "1Wire: Pullup Failed waiting for the line to go high: {}", e)
+            self._reset_mpsse()
+            raise Exception("The 1-wire line didn't go high after the pullup, is it shorted or missing its pull-up?")
+        self._debug(2, "1Wire: Pullup Complete, Returning First Byte: {:x}", byte)
         return byte
 
+    # Get the MPSSE going again after it was left waiting for a line which
+    # never went high. It won't process anything, not even a sync, until it's
+    # reset, so reset it, throw away what's queued, and set it up again.
+    def _reset_mpsse(self):
+        self._debug(1, "MPSSE: Resetting")
+        self.discard_command_buffer()
+        self._rc = False
+        ftdi.usb_purge_buffers(self._ctx)
+        ftdi.set_bitmode(self._ctx, 0, 0)
+        ftdi.set_bitmode(self._ctx, 0, 2)
+        self.sync()
+        self.setup_clock()
+        self.write_gpio_state()
+
     # Write a bit to the 1-wire bus, either a 1 or a 0
     def write_bit(self, bit):
-        self._debug(4, "1Wire: Write Bit: {}".format(bit))
+        if self._dbg >= 4:
+            self._debug(4, "1Wire: Write Bit: {}", bit)
         if bit:
             commands = self.clock_A + self.low + self.delay + self.high + self.clock_B + self.delay 
         else:
@@ -369,71 +687,202 @@ class W1ftdi(object):
         self._write(str(commands))
 
     def read_command(self, bits=1):
-        for i in range(bits):
-            commands = self.clock_A + self.low + self.delay + self.high + self.clock_E +\
-                       self.delay + self.read_gpio + self.clock_F + self.delay
-            self._write(str(commands))
+        self._write(self._read_commands(bits) + self.send_immediate)
 
+    # The commands for bits read slots
+    def _read_commands(self, bits):
+        commands = self.clock_A + self.low + self.delay + self.high + self.clock_E +\
+                   self.delay + self.read_gpio + self.clock_F + self.delay
+        return str(commands) * bits
+
+    # Read the responses to bits read slots, returns the bit for a single slot,
+    # or a bytearray holding the bit (0 or 1) read by each slot.
     def read_response(self, bits=1):
-        states = []
-        read = self._read(2 * bits)
-        for i in range(0,2*bits,2):
-            bit = bytearray([read[i], read[i+1]])
-            states.append( struct.unpack("H", str(bit))[0] >> self.pin & 01 )
-            self._debug(4, "1Wire: Read Bit: {:02x}{:02x} - Pin: {} is {}".format(bit[0],bit[1], self.pin, states[-1]))
+        states = self._decode_bits(self._read(2 * bits))
+        if self._dbg >= 4:
+            self._debug(4, "1Wire: Read Bits: Pin: {} is {}", self.pin, "".join(str(b) for b in states))
         if bits == 1:
-            return states.pop()
+            return states[0]
         return states
 
+    # Decode the GPIO samples for a run of read slots in one pass
+    def _decode_bits(self, read):
+        return read[self._sample_offset::2].translate(self._sample_table)
+
+    # Pack the bits (0 or 1) from read_response() into bytes, LSB first
+    def _pack_bits(self, bits):
+        bits = str(bits)
+        if len(bits) & 0x07:
+            bits += "\x00" * (8 - (len(bits) & 0x07))
+        table = self._pack_table
+        return bytearray(table[bits[i:i+8]] for i in xrange(0, len(bits), 8))
+
     # Read a bit from the 1-wire bus.
     def read_bit(self):
         self.read_command()
         return self.read_response()
 
-    # Use the write_bit function to write bytes out to the bus
+    # Write a byte to the bus using the precompiled table for the current speed
     def write_byte(self, byte):
-        manage_buffer = self._buffer == False
-        self._debug(3, "1Wire: Write Byte: {:02x}, Managed Buffer: {}".format(byte, manage_buffer))
-        if manage_buffer:
-            self.enable_command_buffer()
-        for i in range(8):
-            self.write_bit(byte & 1)
-            byte >>= 1
-        if manage_buffer:
-            self.flush_command_buffer()
+        if self._dbg >= 3:
+            self._debug(3, "1Wire: Write Byte: {:02x}, Buffered: {}", byte, self._buffer)
+        table = self._write_table
+        if table is None:
+            table = self._build_write_table()
+        self._write(table[byte & 0xff])
 
     # write multiple bytes to the bus
     def write_bytes(self, data):
         if type(data) is str:
             data = bytearray( data )
+        table = self._write_table
+        if table is None:
+            table = self._build_write_table()
         try:
-            for byte in data:
-                self.write_byte(byte)
+            commands = "".join(table[byte & 0xff] for byte in data)
         except TypeError:
-            self.write_byte(data)
+            return self.write_byte(data)
+        if self._dbg >= 3:
+            self._debug(3, "1Wire: Write Bytes: {}", len(data))
+        self._write(commands)
 
-    # Use the read_bit function to read bytes from the bus
+    # Read a byte from the bus, sending any commands already buffered with
+    # the read slots.
     def read_byte(self):
-        byte = 0
-        manage_buffer = self._buffer == False
-        if manage_buffer:
+        if self._buffer is False:
             self.enable_command_buffer()
         self.read_command(8)
-        if manage_buffer:
-            self.flush_command_buffer()
-        bits = self.read_response(8)
-        for i in range(8):
-            byte |= bits[i] << i
-        self._debug(3, "1Wire: Read Byte: {:02x}, Managed Buffer: {}".format(byte, manage_buffer))
+        self.flush_command_buffer()
+        byte = self._pack_bits(self.read_response(8))[0]
+        if self._dbg >= 3:
+            self._debug(3, "1Wire: Read Byte: {:02x}", byte)
         return byte 
 
-    # Read multiple bytes from the 1-wire bus
+    # Stream transfers through the MPSSE. transfers is an iterable of
+    # (commands, length) where length is the bytes the commands send back,
+    # and commands is a str, or a function which writes them. Transfers are
+    # grouped into windows of up to STREAM_WINDOW response bytes, each sent in
+    # one write, and the next window is sent before reading back the last, so
+    # the FT232H is never left waiting on the host. Windows are only sent while
+    # the responses not yet read fit in the receive FIFO, so it can't overflow
+    # however long the stream. Any commands already buffered go with the first
+    # window. Yields the response to each transfer, in order.
+    def stream(self, transfers, window=STREAM_WINDOW):
+        inflight = collections.deque()
+        pending = []
+        size = 0
+        try:
+            for commands, length in transfers:
+                if length > FT232H_RX_FIFO:
+                    raise Exception("A streamed transfer can read at most {} bytes".format(FT232H_RX_FIFO))
+                if pending and size + length > window:
+                    for response in self._stream_send(inflight, pending, size):
+                        yield response
+                    pending = []
+                    size = 0
+                if self._buffer is False:
+                    self.enable_command_buffer()
+                if type(commands) is str:
+                    self._write(commands)
+                else:
+                    commands()
+                pending.append(length)
+                size += length
+            for response in self._stream_send(inflight, pending, size):
+                yield response
+            for response in self._stream_receive(inflight, len(inflight)):
+                yield response
+        except GeneratorExit:
+            # Abandoned part way, read back what's in flight so it doesn't
+            # turn up as the response to something else.
+            self.discard_command_buffer()
+            self._stream_drain(inflight)
+            raise
+        except:
+            # Failed part way, there's no telling what's left in the FIFO, so
+            # throw it all away.
+            self.discard_command_buffer()
+            self.flush()
+            raise
+
+    # Read back and throw away the windows in flight, flushing the FIFO if
+    # they can't be read. Never raises, so it can't hide why the stream
+    # stopped.
+    def _stream_drain(self, inflight):
+        try:
+            self._stream_receive(inflight, len(inflight))
+        except Exception as e:
+            self._debug(1, "MPSSE: Stream: Failed to read back the responses in flight: {}", e)
+            self.flush()
+
+    # Send the buffered window, once the responses in flight leave room for
+    # its size bytes. Returns the responses read back to make room.
+    def _stream_send(self, inflight, lengths, size):
+        responses = []
+        while inflight and sum(sum(sent) for sent in inflight) + size > FT232H_RX_FIFO:
+            responses.extend(self._stream_receive(inflight))
+        if self._buffer is False:
+            self.enable_command_buffer()
+        if size:
+            self._write(self.send_immediate)
+        self.flush_command_buffer()
+        if size:
+            inflight.append(lengths)
+        else:
+            responses.extend(bytearray() for length in lengths)
+        return responses
+
+    # Read back the oldest windows in flight, in a single read, returns their
+    # responses
+    def _stream_receive(self, inflight, windows=1):
+        lengths = []
+        for i in range(windows):
+            lengths.extend(inflight.popleft())
+        if not lengths:
+            return []
+        response = self._read(sum(lengths))
+        responses = []
+        offset = 0
+        for length in lengths:
+            responses.append(response[offset:offset+length])
+            offset += length
+        return responses
+
+    # Read multiple bytes from the 1-wire bus. The read slots are streamed,
+    # see stream(), with any commands already buffered going first.
     def read_bytes(self, count):
-        data = bytearray(count)
-        for i in range(count):
-            data[i] = self.read_byte()
+        data = bytearray()
+        chunk = STREAM_WINDOW // 16
+        transfers = ((self._read_commands(8 * size), 16 * size)
+                     for size in (min(chunk, count - start) for start in xrange(0, count, chunk)))
+        for response in self.stream(transfers):
+            data.extend(self._pack_bits(self._decode_bits(response)))
+        if self._dbg >= 3:
+            self._debug(3, "1Wire: Read Bytes: {}", self.bytes2string(data))
         return data
 
+    # Address each ROM in turn, send it command and read count bytes back. The
+    # transactions are streamed, see stream(). Returns a bytearray holding
+    # count bytes for each ROM, filling buffer if one is given. A missing
+    # device returns 0xff's.
+    def read_each(self, roms, command, count, buffer=None):
+        size = 4 + 16 * count
+        if size > FT232H_RX_FIFO:
+            raise Exception("read_each() can read at most {} bytes".format((FT232H_RX_FIFO - 4) // 16))
+        if buffer is None:
+            buffer = bytearray(count * len(roms))
+        slots = self._read_commands(8 * count)
+        def transaction(rom):
+            self._write(self._reset_command())
+            self.address_rom(rom)
+            self.write_bytes(command)
+            self._write(slots)
+        transfers = ((lambda rom=rom: transaction(rom), size) for rom in roms)
+        for offset, response in enumerate(self.stream(transfers)):
+            bits = self._decode_bits(response[4:])
+            buffer[offset*count:(offset+1)*count] = self._pack_bits(bits)
+        return buffer
+
     # read multiple bits from the 1-wire bus. Used for device discovery
     def read_bits(self, count):
         bits = []
@@ -448,7 +897,7 @@ class W1ftdi(object):
         self.write_byte(0x33)
         for i in range(8):
             rom[i] = self.read_byte()
-        self._debug(1, "rom_read discovered: {}".format(self.bytes2string(rom)))
+        self._debug(1, "rom_read discovered: {}", self.bytes2string(rom))
         return rom 
 
     # Issue a skip rom for overdrive, we can then perform a search at OD speed, or
@@ -478,84 +927,203 @@ class W1ftdi(object):
 
     # Address the ROM if given, else perform a skip_rom()
     def address_rom(self, rom):
+        if self.stats is not None:
+            self.stats.addressed(rom)
         if rom is None:
-            self._debug(3, "1Wire: Skip ROM")
+            if self._dbg >= 3:
+                self._debug(3, "1Wire: Skip ROM")
             self.skip_rom()
         else:
-            self._debug(3, "1Wire: Match ROM")
+            if self._dbg >= 3:
+                self._debug(3, "1Wire: Match ROM")
             self._match_rom(rom)
 
     # Resume, you should only call this if the ROM has been addressed previously
     def resume(self):
-        self._debug(3, "1Wire: Resume")
+        if self._dbg >= 3:
+            self._debug(3, "1Wire: Resume")
         self.write_byte(0xa5)
 
-    # Search for ROMs on the 1-wire bus
-    def search_roms(self):
+    # Search for ROMs on the 1-wire bus. If family is given (a family code, or
+    # a list of them) then the search is seeded with the family code, and only
+    # devices from those families are enumerated.
+    def search_roms(self, family=None):
+        if family is None:
+            seeds = [ [] ]
+        elif type(family) is int:
+            seeds = [ self._family_bits(family) ]
+        else:
+            seeds = [ self._family_bits(f) for f in family ]
+        return self._search_seeds(seeds)
+
+    # Search each of the seeded partial ROMs, and any forks found from them
+    def _search_seeds(self, seeds):
         roms_found = []
-        partials = [ [] ]
         self._debug(1, "Search Start")
-        while len(partials) > 0:
+        for seed in seeds:
+            partials = []
             self._debug(1, "Searching....")
-            rom = partials.pop()
-            roms_found.append( self.bytes2string(self._search(rom, partials)) )
+            rom = self._search(seed, partials, seeded=len(seed) > 0)
+            if rom is not None:
+                roms_found.append( self.bytes2string(rom) )
+            while len(partials) > 0:
+                self._debug(1, "Searching....")
+                rom = self._search(partials.pop(), partials)
+                if rom is not None:
+                    roms_found.append( self.bytes2string(rom) )
         self._debug(1, "Search Complete")
         return roms_found
-        
-    # When replaying the partial rom, flush the search out to the MPSSE every 10 bits
-    # improves performance.
-    def _search_flush_rom(self, count):
-        self.flush_command_buffer()
-        self.read_response(2*count)
-        return 0
 
-    # Do the search for each partial ROM
-    def _search(self, rom=[], partials=[]):
+    # Check known ROMs are still on the bus. For each ROM a reset and a search
+    # along the ROM's own path is sent, reading the id/complement bits at every
+    # position, and as many ROMs as the receive buffer can hold go in a single
+    # round trip. Returns a dict of ROM: (present, forks), where forks lists the
+    # positions at which other devices took the other branch.
+    def verify_roms(self, roms):
+        results = {}
+        zero, one, read = self._get_slots()
+        size = 4 + 64 * 4
+        chunk = max(1, FT232H_RX_FIFO // size)
+        for start in range(0, len(roms), chunk):
+            batch = roms[start:start+chunk]
+            commands = []
+            for rom in batch:
+                commands.append(self._reset_command())
+                commands.append(self._write_table[0xf0])
+                for bit in self._rom_bits(rom):
+                    commands.append(read + read + (one if bit else zero))
+            commands.append(self.send_immediate)
+            self._write("".join(commands))
+            response = self._read(size * len(batch))
+            for i, rom in enumerate(batch):
+                results[rom] = self._verify_response(rom, response[i*size:(i+1)*size])
+        return results
+
+    # Decode the reset and search responses for a ROM from verify_roms()
+    def _verify_response(self, rom, response):
+        if self._decode_bits(response[:4])[0] != 0:
+            self._debug(2, "Verify: No presence pulse for ROM {}", rom)
+            return (False, [])
+        bits = self._decode_bits(response[4:])
+        forks = []
+        for i, bit in enumerate(self._rom_bits(rom)):
+            id_bit = bits[2*i]
+            cmp_bit = bits[2*i+1]
+            if (bit == 0 and id_bit != 0) or (bit == 1 and cmp_bit != 0):
+                self._debug(2, "Verify: ROM {} missing at bit {}", rom, i)
+                return (False, [])
+            if id_bit == 0 and cmp_bit == 0:
+                forks.append(i)
+        self._debug(2, "Verify: ROM {} present, forks at {}", rom, forks)
+        return (True, forks)
+
+    # Refresh the registry of known ROMs (a W1registry, or the path to its file)
+    # without a full search. Known ROMs are verified, and only branches of the
+    # search tree which lead to no known ROM are searched. A full search is only
+    # needed when the registry is empty, or a device present last time has gone
+    # missing.
+    # Returns the ROMs present.
+    def refresh_roms(self, registry):
+        if type(registry) is str:
+            registry = W1registry(registry)
+        now = time.time()
+        known = registry.known()
+        if len(known) == 0:
+            found = self.search_roms()
+        else:
+            # ROMs already missing are verified too, in case they came back,
+            # but only a ROM which was present last time can hide others
+            results = self.verify_roms(known)
+            present = [ rom for rom in known if results[rom][0] ]
+            vanished = [ rom for rom in registry.present() if not results[rom][0] ]
+            if vanished or len(present) == 0:
+                self._debug(1, "Refresh: {} devices missing, searching", len(vanished))
+                found = self.search_roms()
+            else:
+                prefixes = set()
+                for rom in present:
+                    bits = tuple(self._rom_bits(rom))
+                    for i in range(64):
+                        prefixes.add(bits[:i+1])
+                seeds = []
+                for rom in present:
+                    bits = self._rom_bits(rom)
+                    for i in results[rom][1]:
+                        branch = tuple(bits[:i]) + (bits[i] ^ 1,)
+                        if branch not in prefixes:
+                            prefixes.add(branch)
+                            seeds.append(list(branch))
+                self._debug(1, "Refresh: {} unknown branches to search", len(seeds))
+                found = present + self._search_seeds(seeds)
+        registry.update(found, now)
+        registry.save()
+        return found
+
+    # Return the bits of a ROM in the order they are sent on the bus
+    def _rom_bits(self, rom):
+        if type(rom) is str:
+            rom = self.string2bytes(rom)
+        return [ (rom[i >> 3] >> (i & 0x07)) & 0x01 for i in range(64) ]
+
+    # The search directions which select a family code
+    def _family_bits(self, family):
+        return [ (family >> i) & 1 for i in range(8) ]
+        
+    # Do the search for each partial ROM. Each bit position costs one round
+    # trip: the direction chosen for a position goes out in the same write as
+    # the id/complement read slots of the next position. Any partial ROM is
+    # replayed in the same write as the first new position. A seeded ROM has
+    # not been seen on the bus, so if no device answers after it is replayed,
+    # None is returned.
+    def _search(self, rom=[], partials=[], seeded=False):
 
         if self.reset() is False:
             return
 
-        # Dump any partial rom to the MPSSE in 10bit chunks
-        self.enable_command_buffer()
-        self.write_byte(0xf0)
-        count = 0
+        trips = self.round_trips
+        zero, one, read = self._get_slots()
+
+        # When replaying we already know the id/complement bits, so the slaves
+        # only need the read slots, which are timed the same as writing a 1.
+        commands = [ self._write_table[0xf0] ]
         for bit in rom:
-            if count == 10:
-                count = self._search_flush_rom(10)
-                self.enable_command_buffer()
-            count += 1
-            self.read_command(2)
-            self.write_bit(bit)
-        self._search_flush_rom(count)
+            commands.append(one + one)
+            commands.append(one if bit else zero)
 
         # Continue the search from where we are.
         for i in range(64 - len(rom)):
-            bits = self.read_bits(2)
+            commands.append(read + read + self.send_immediate)
+            self._write("".join(commands))
+            bits = self.read_response(2)
             if bits[0] != bits[1]:
-                self._debug(3, "Search Match: Found single host or matching bits. Continuing")
+                if self._dbg >= 3:
+                    self._debug(3, "Search Match: Found single host or matching bits. Continuing")
                 rom.append(bits[0])
-                self.write_bit(bits[0])
-            elif bits == [False, False]:
-                self._debug(2, "Search Fork: Found mismatch. Storing partial. Continuing")
+            elif bits[0] == 0:
+                if self._dbg >= 2:
+                    self._debug(2, "Search Fork: Found mismatch. Storing partial. Continuing")
                 np = list(rom)
-                np.append(True)
+                np.append(1)
                 partials.append( np )
-                rom.append(False)
-                self.write_bit(False)
+                rom.append(0)
+            elif seeded:
+                self._debug(2, "Search End: No devices match ROM {}", rom)
+                return None
             else:
                 self._debug(1, "Search Fail: Unexpected end of Device Search. No Response from slaves")
                 raise Exception("Search Failed. Device Comms Interrupted")
+            commands = [ one if rom[-1] else zero ]
+            seeded = False
 
-        complete = bytearray(8)
-        for i in range(8):
-            byte = 0
-            for o in range(8):
-                bit = rom[(i*8)+o]
-                byte |= bit << o
-            complete[i] = byte
+        # Send the final direction, to select the device
+        self._write("".join(commands))
 
-        self._debug( 1, "Search Found: ROM {}".format( self.bytes2string(complete)))
+        complete = self._pack_bits(bytearray(rom))
+        if self._dbg >= 1:
+            self._debug(1, "Search Found: ROM {}, Round trips: {}",
+                        self.bytes2string(complete), self.round_trips - trips)
         if self.crc(complete) is not 0x00:
+            self._crc_failure(complete)
             raise Exception("CRC Check Failed")
         return complete
         
@@ -569,23 +1137,33 @@ class W1ftdi(object):
 
     # Calculate CRC, result should be 0x00
     def crc(self, data, bits=8):
-
         if bits == 8:
-            poly = 0x8c # x8,x5,x4,+ 1 inverse of 0x131 & 0xff
+            crc = crc8(data)
         elif bits == 16:
-            poly = 0xa001 # x16, x15, x2, +1
+            crc = crc16(data)
         else:
             raise Exception("Unsupported CRC length")
-        crc = 0x00
-        for byte in data:
-            for bit in range(8):
-                # When bit is on, shift and xor, else just shift
-                if ( byte ^ crc) & 0x01:
-                    crc >>= 1
-                    crc ^= poly
-                else:
-                    crc >>= 1
-                byte >>= 1
-        self._debug(3, "CRC Check returned: {:02x}".format(crc))
+        if self._dbg >= 3:
+            self._debug(3, "CRC Check returned: {:02x}", crc)
         return crc
 
+# List the attached FT232H adapters as (index, serial, description) tuples. The
+# index or serial can be passed as the device to W1ftdi (and the drivers).
+def find_adapters(vid=FT232H_VID, pid=FT232H_PID):
+    ctx = ftdi.new()
+    if ctx == 0:
+        raise Exception("Failed to open FTDI")
+    adapters = []
+    try:
+        ret, devlist = ftdi.usb_find_all(ctx, vid, pid)
+        if ret < 0:
+            raise Exception("Failed to list FTDI devices: {}".format(ret))
+        node = devlist
+        while node is not None:
+            ret, manufacturer, description, serial = ftdi.usb_get_strings(ctx, node.dev)
+            adapters.append((len(adapters), serial, description))
+            node = node.next
+        ftdi.list_free(devlist)
+    finally:
+        ftdi.free(ctx)
+    return adapters
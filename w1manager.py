@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Run several FT232H adapters in parallel
+#
+# Each adapter gets a worker thread, which opens it and repeatedly runs a job
+# on it. The results from every adapter are merged into one stream:
+#
+#   manager = W1manager(lambda device: Ds18b20(8, device=device))
+#   manager.start(lambda ds: ds.get_temps(), rate=5)
+#   for device, timestamp, temps in manager.stream():
+#       ...
+#
+# Most of an adapter's time is spent waiting on USB or for conversions, so
+# threads are enough for the total throughput to scale with the adapters.
+
+import threading
+import time
+import Queue
+
+from w1ftdi import find_adapters
+import w1trace
+
+class W1manager(object):
+
+    # factory(device) returns an opened W1ftdi (or driver) for the device.
+    # devices defaults to the serial numbers of every attached FT232H.
+    def __init__(self, factory, devices=None, debug=0):
+        self.factory = factory
+        if devices is None:
+            devices = [ serial for index, serial, description in find_adapters() ]
+        self.devices = devices
+        self._dbg = debug
+        if debug:
+            w1trace.default_handler()
+        self._queue = Queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    # Debug function, see W1ftdi._debug()
+    def _debug(self, level, msg, *args):
+        if self._dbg >= level:
+            w1trace.log(level, msg, args)
+
+    # Start a worker for each adapter, running job(w1) every rate seconds, or
+    # count times if given.
+    def start(self, job, rate=1.0, count=None):
+        if self._threads:
+            raise Exception("Manager already started")
+        self._stop.clear()
+        self._queue = Queue.Queue()
+        for device in self.devices:
+            thread = threading.Thread(target=self._worker, args=(device, job, rate, count),
+                                      name="w1-{}".format(device))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    # Worker thread for one adapter. Results are queued as (device, timestamp,
+    # result). If the job raises, the exception is queued as the result and the
+    # worker carries on. A None result marks the end of the worker.
+    def _worker(self, device, job, rate, count):
+        w1 = None
+        try:
+            w1 = self.factory(device)
+            samples = 0
+            due = time.time()
+            while not self._stop.is_set():
+                try:
+                    result = job(w1)
+                except Exception as e:
+                    self._debug(1, "Manager: {} failed: {}", device, e)
+                    result = e
+                self._queue.put((device, time.time(), result))
+                samples += 1
+                if count is not None and samples >= count:
+                    break
+                due += rate
+                delay = due - time.time()
+                if delay > 0:
+                    self._stop.wait(delay)
+                else:
+                    due = time.time()
+        except Exception as e:
+            self._debug(1, "Manager: {} failed to open: {}", device, e)
+            self._queue.put((device, time.time(), e))
+        finally:
+            if w1 is not None:
+                w1.close()
+            self._queue.put((device, time.time(), None))
+
+    # Yield (device, timestamp, result) from every adapter, as they arrive,
+    # until all the workers have finished or been stopped.
+    def stream(self):
+        running = len(self._threads)
+        while running:
+            # Queue.get() without a timeout ignores KeyboardInterrupt
+            try:
+                device, timestamp, result = self._queue.get(True, 1.0)
+            except Queue.Empty:
+                continue
+            if result is None:
+                running -= 1
+                continue
+            yield device, timestamp, result
+
+    # Stop the workers, and wait for them to close their adapters
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
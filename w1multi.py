@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Several 1-wire buses on one FT232H, driven in lock-step
+#
+# Each GPIO write sets all 16 pins, and each GPIO read samples them all, so
+# buses on different pins can share every slot. A lock-step write slot pulls
+# all the buses low, releases those writing a 1 after tA, and those writing a
+# 0 after tC. A read slot samples once, and each bus's bit is picked out of
+# the same sample. So N buses cost no more USB traffic than one.
+#
+# The W1ftdi methods still work on one bus at a time, pick it with select().
+# The *_all methods work on every bus at once. They take and return a list
+# with an entry per bus, where a None entry leaves that bus idle. Overdrive
+# and the strong pullup are not supported.
+
+from w1ftdi import W1ftdi, FT232H_RX_FIFO, LATENCY, STREAM_WINDOW
+
+class W1multi(W1ftdi):
+
+    _instrumented = W1ftdi._instrumented + ("reset_all", "write_bytes_all", "read_bits_all",
+                                            "read_bytes_all", "read_each_all", "search_all")
+
+    def __init__(self, pins, debug=0, latency=LATENCY, device=None):
+        self.pins = list(pins)
+        if len(set(self.pins)) != len(self.pins):
+            raise Exception("Each bus needs its own pin")
+        self._gpio_cmds = {}
+        self._lockstep = {}
+        super(W1multi, self).__init__(self.pins[0], debug, overdrive=False, latency=latency, device=device)
+        self._bus_tables = []
+        for pin in self.pins:
+            shift = pin & 0x07
+            self._bus_tables.append((pin >> 3, "".join(chr((b >> shift) & 0x01) for b in range(256))))
+
+    # The delay between releasing the buses writing a 1 (tA), and those writing
+    # a 0 (tC).
+    def _reset_clocks(self, overdrive):
+        super(W1multi, self)._reset_clocks(overdrive)
+        self.clock_R = self._get_delay_cmd(0.000060 - 0.000006)
+
+    # As W1ftdi.set_pin(), also keeping the idle GPIO state (all buses
+    # released) which the lock-step commands are built from.
+    def set_pin(self, pin, out, high):
+        super(W1multi, self).set_pin(pin, out, high)
+        self._idle_level = self._level
+        self._idle_direction = self._direction
+        self._gpio_cmds = {}
+        self._lockstep = {}
+
+    # Point the single bus W1ftdi methods at the bus on pins[index]
+    def select(self, index):
+        self._debug(3, "1Wire: Selecting bus {} on pin {}", index, self.pins[index])
+        self.pin = self.pins[index]
+        self._rc = False
+        self._build_read_tables()
+        self.set_pin(self.pin, False, True)
+
+    # The GPIO mask for the buses with an entry which isn't None
+    def _mask(self, active):
+        mask = 0
+        for i, entry in enumerate(active):
+            if entry is not None:
+                mask |= 1 << self.pins[i]
+        return mask
+
+    # The MPSSE command to pull the buses in mask low, and release the rest
+    def _gpio_cmd(self, mask):
+        cmd = self._gpio_cmds.get(mask)
+        if cmd is None:
+            level = self._idle_level & ~mask
+            direction = self._idle_direction | mask
+            cmd = str(bytearray((0x80, level & 0xff, direction & 0xff,
+                                 0x82, (level >> 8) & 0xff, (direction >> 8) & 0xff)))
+            self._gpio_cmds[mask] = cmd
+        return cmd
+
+    # A write slot on the buses in mask, where the buses in zeros write a 0
+    def _write_slot(self, mask, zeros):
+        key = ("w", mask, zeros)
+        slot = self._lockstep.get(key)
+        if slot is None:
+            slot = str(self.clock_A) + self._gpio_cmd(mask) + self.delay + self._gpio_cmd(zeros) + \
+                   str(self.clock_R) + self.delay + self._gpio_cmd(0) + str(self.clock_D) + self.delay
+            self._lockstep[key] = slot
+        return slot
+
+    # A read slot on the buses in mask
+    def _read_slot(self, mask):
+        key = ("r", mask)
+        slot = self._lockstep.get(key)
+        if slot is None:
+            slot = str(self.clock_A) + self._gpio_cmd(mask) + self.delay + self._gpio_cmd(0) + \
+                   str(self.clock_E) + self.delay + self.read_gpio + str(self.clock_F) + self.delay
+            self._lockstep[key] = slot
+        return slot
+
+    # A reset on the buses in mask, the GPIO is read during and after the
+    # presence pulse.
+    def _reset_slot(self, mask):
+        key = ("x", mask)
+        slot = self._lockstep.get(key)
+        if slot is None:
+            slot = str(self.clock_G) + self._gpio_cmd(0) + self.delay + str(self.clock_H) + \
+                   self._gpio_cmd(mask) + self.delay + self._gpio_cmd(0) + str(self.clock_I) + \
+                   self.delay + self.read_gpio + str(self.clock_J) + self.delay + self.read_gpio
+            self._lockstep[key] = slot
+        return slot
+
+    # An entry for every bus, or all buses if active is None
+    def _active(self, active):
+        if active is None:
+            return [ True ] * len(self.pins)
+        if len(active) != len(self.pins):
+            raise Exception("Expected an entry for each of the {} buses".format(len(self.pins)))
+        return active
+
+    # Pick out the bits read by each bus from the GPIO samples
+    def _decode_all(self, read, active):
+        states = []
+        for i, entry in enumerate(active):
+            if entry is None:
+                states.append(None)
+            else:
+                offset, table = self._bus_tables[i]
+                states.append(read[offset::2].translate(table))
+        return states
+
+    # Reset the buses, returns a list of True/False for the presence of devices
+    # on each bus (None for idle buses).
+    def reset_all(self, active=None):
+        active = self._active(active)
+        if self._dbg >= 2:
+            self._debug(2, "1Wire: Reset all")
+        if self.stats is not None:
+            self.stats.bus_reset()
+        self._write(self._reset_slot(self._mask(active)) + self.send_immediate)
+        states = self._decode_all(self._read(4), active)
+        return [ None if bits is None else 0 in bits for bits in states ]
+
+    # The lock-step commands to write datas, a str or bytearray per bus, which
+    # must all be the same length. One str or bytearray is written to all.
+    def _write_commands(self, datas):
+        if type(datas) in (str, bytearray):
+            datas = [ datas ] * len(self.pins)
+        datas = [ None if data is None else bytearray(data) for data in self._active(datas) ]
+        buses = [ i for i, data in enumerate(datas) if data is not None ]
+        if len(set(len(datas[i]) for i in buses)) > 1:
+            raise Exception("Lock-step writes must be the same length on every bus")
+        if not buses:
+            return ""
+        mask = self._mask(datas)
+        commands = []
+        for j in range(len(datas[buses[0]])):
+            for bit in range(8):
+                zeros = 0
+                for i in buses:
+                    if not (datas[i][j] >> bit) & 0x01:
+                        zeros |= 1 << self.pins[i]
+                commands.append(self._write_slot(mask, zeros))
+        return "".join(commands)
+
+    # Write bytes to every bus at once, see _write_commands()
+    def write_bytes_all(self, datas):
+        if self._dbg >= 3:
+            self._debug(3, "1Wire: Write Bytes all")
+        self._write(self._write_commands(datas))
+
+    # Read count bits from every active bus. Returns a list with a bytearray of
+    # bits (0 or 1) per bus.
+    def read_bits_all(self, count, active=None):
+        active = self._active(active)
+        slot = self._read_slot(self._mask(active))
+        states = [ None if entry is None else bytearray() for entry in active ]
+        chunk = STREAM_WINDOW // 2
+        transfers = ((slot * size, 2 * size)
+                     for size in (min(chunk, count - done) for done in xrange(0, count, chunk)))
+        for response in self.stream(transfers):
+            for bits, read in zip(states, self._decode_all(response, active)):
+                if bits is not None:
+                    bits.extend(read)
+        return states
+
+    # Read count bytes from every active bus
+    def read_bytes_all(self, count, active=None):
+        return [ None if bits is None else self._pack_bits(bits)
+                 for bits in self.read_bits_all(8 * count, active) ]
+
+    # The lock-step version of W1ftdi.read_each(). roms holds a list of ROMs
+    # for each bus. The nth ROM on every bus is addressed together, and sent
+    # command, and count bytes are read back. Returns a bytearray per bus with
+    # count bytes for each of its ROMs.
+    def read_each_all(self, roms, command, count):
+        roms = [ [ self.string2bytes(rom) if type(rom) is str else rom for rom in bus ]
+                 for bus in self._active([ [] if bus is None else bus for bus in roms ]) ]
+        size = 4 + 16 * count
+        if size > FT232H_RX_FIFO:
+            raise Exception("read_each_all() can read at most {} bytes".format((FT232H_RX_FIFO - 4) // 16))
+        if type(command) is int:
+            command = chr(command)
+        rounds = max([ len(bus) for bus in roms ] or [0])
+        actives = [ [ True if r < len(bus) else None for bus in roms ] for r in range(rounds) ]
+        buffers = [ bytearray() for bus in roms ]
+        def transfer(r):
+            mask = self._mask(actives[r])
+            return (self._reset_slot(mask) +
+                    self._write_commands([ None if entry is None else '\x55' + str(bus[r]) + command
+                                           for entry, bus in zip(actives[r], roms) ]) +
+                    self._read_slot(mask) * (8 * count), size)
+        for r, response in enumerate(self.stream(transfer(r) for r in range(rounds))):
+            for buffer, bits in zip(buffers, self._decode_all(response[4:], actives[r])):
+                if bits is not None:
+                    buffer.extend(self._pack_bits(bits))
+        return buffers
+
+    # Search each bus in turn, see W1ftdi.search_roms(). Returns a list of ROMs
+    # per bus.
+    def search_all(self, family=None):
+        selected = self.pins.index(self.pin)
+        found = []
+        for i in range(len(self.pins)):
+            self.select(i)
+            found.append(self.search_roms(family))
+        self.select(selected)
+        return found
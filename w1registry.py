@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Registry of ROMs discovered on a bus, persisted to a JSON file so we don't
+# need a full search of the bus each time we start. See W1ftdi.refresh_roms()
+#
+# The file holds a dictionary of ROM: { first_seen, last_seen, present }
+
+import json
+import os
+import time
+
+class W1registry(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.roms = {}
+        self.load()
+
+    # Load the registry, if the file doesn't exist yet it starts empty
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.roms = dict((str(rom), info) for rom, info in json.load(f).items())
+        else:
+            self.roms = {}
+
+    # Save the registry. Written to a temporary file first, and renamed over
+    # the old one, so a crash never leaves us with half a registry.
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.roms, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    # All ROMs we have seen, present or not
+    def known(self):
+        return sorted(self.roms.keys())
+
+    # ROMs which were present when last checked
+    def present(self):
+        return sorted(rom for rom, info in self.roms.items() if info["present"])
+
+    # ROMs which were missing when last checked
+    def missing(self):
+        return sorted(rom for rom, info in self.roms.items() if not info["present"])
+
+    # When a ROM was last seen on the bus, or None
+    def last_seen(self, rom):
+        if rom in self.roms:
+            return self.roms[rom]["last_seen"]
+        return None
+
+    # Record a ROM as seen on the bus
+    def seen(self, rom, when=None):
+        if when is None:
+            when = time.time()
+        if rom not in self.roms:
+            self.roms[rom] = { "first_seen": when, "last_seen": when, "present": True }
+        else:
+            self.roms[rom]["last_seen"] = when
+            self.roms[rom]["present"] = True
+
+    # Record the result of checking the bus, ROMs found are seen, all others
+    # are marked missing.
+    def update(self, found, when=None):
+        for rom in found:
+            self.seen(rom, when)
+        for rom in self.roms:
+            if rom not in found:
+                self.roms[rom]["present"] = False
+
+    # Forget a ROM
+    def remove(self, rom):
+        self.roms.pop(rom, None)
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Share one W1ftdi between many threads
+#
+# W1ftdi isn't thread safe, so the scheduler owns it, and runs transactions
+# for the other threads one at a time on its own thread. Each caller gets a
+# future back:
+#
+#   scheduler = W1scheduler(Ds18b20(8))
+#   data = scheduler.transaction(rom, 0xbe, 9).result()
+#   temps = scheduler.submit(Ds18b20.get_temps, roms, key="temps").result()
+#
+# Transactions run in priority order (lowest first), then in the order they
+# were submitted. Requests with the same key are coalesced: while one is
+# queued or running, or for ttl seconds after it completed, the others get
+# the same future. The futures come from the futures package.
+
+import itertools
+import threading
+import time
+import Queue
+
+from concurrent.futures import Future
+
+import w1trace
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+TTL = 1.0             # Seconds a result is shared with new requests
+
+# Run a transaction, through the instance so that it's seen by enable_stats().
+# The result is shared by every coalesced caller, so it's returned as a str
+# which none of them can change.
+def _read_each(w1, rom, command, count):
+    return str(w1.read_each([ rom ], command, count))
+
+class W1scheduler(object):
+
+    def __init__(self, w1, ttl=TTL, debug=0):
+        self.w1 = w1
+        self.ttl = ttl
+        self._dbg = debug
+        if debug:
+            w1trace.default_handler()
+        self._queue = Queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._inflight = {}
+        self._results = {}
+        self._closed = False
+        self.executed = 0
+        self.coalesced = 0
+        self._thread = threading.Thread(target=self._run, name="w1-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Debug function, see W1ftdi._debug()
+    def _debug(self, level, msg, *args):
+        if self._dbg >= level:
+            w1trace.log(level, msg, args)
+
+    # Queue func(w1, *args) to run on the scheduler's thread. Takes priority
+    # and key keyword arguments. Returns a future for the result.
+    def submit(self, func, *args, **kwargs):
+        priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        key = kwargs.pop("key", None)
+        if kwargs:
+            raise TypeError("Unexpected arguments: {}".format(", ".join(kwargs)))
+        with self._lock:
+            if self._closed:
+                raise Exception("Scheduler is closed")
+            if key is not None:
+                future = self._coalesce(key)
+                if future is not None:
+                    self.coalesced += 1
+                    self._debug(3, "Scheduler: Coalesced {}", key)
+                    return future
+            future = Future()
+            if key is not None:
+                self._inflight[key] = future
+            self._queue.put((priority, next(self._seq), future, key, func, args))
+        return future
+
+    # A future for key which is still pending, or completed within the ttl
+    def _coalesce(self, key):
+        future = self._inflight.get(key)
+        if future is not None:
+            return future
+        done = self._results.get(key)
+        if done is not None:
+            if time.time() - done[0] < self.ttl:
+                return done[1]
+            del self._results[key]
+        return None
+
+    # Reset the bus, address rom (or skip ROM if None), send command and read
+    # count bytes back. Identical transactions are coalesced. Returns a future
+    # for the bytes read, as a str.
+    def transaction(self, rom, command, count, priority=PRIORITY_NORMAL):
+        # ROMs and commands may be given as bytearrays, which can't be hashed,
+        # so the key is built from the ROM string and command bytes
+        if rom is not None and type(rom) is not str:
+            rom = self.w1.bytes2string(rom)
+        if type(command) is int:
+            command = [ command ]
+        command = str(bytearray(command))
+        key = ("transaction", rom, command, count)
+        return self.submit(_read_each, rom, command, count, priority=priority, key=key)
+
+    # Run the queued transactions until closed
+    def _run(self):
+        while True:
+            priority, seq, future, key, func, args = self._queue.get()
+            if func is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._inflight.pop(key, None)
+                continue
+            self._debug(3, "Scheduler: Running {} priority {}", key or func, priority)
+            try:
+                result = func(self.w1, *args)
+            except Exception as e:
+                self._debug(1, "Scheduler: {} failed: {}", key or func, e)
+                self._recover()
+                with self._lock:
+                    self._inflight.pop(key, None)
+                future.set_exception(e)
+                continue
+            self.executed += 1
+            with self._lock:
+                if key is not None:
+                    self._inflight.pop(key, None)
+                    self._expire()
+                    self._results[key] = (time.time(), future)
+            future.set_result(result)
+        self.w1.close()
+
+    # Put the W1ftdi back into a known state after a failed transaction, so
+    # it doesn't leak into the next one.
+    def _recover(self):
+        self.w1.discard_command_buffer()
+        self.w1._rc = False
+        try:
+            self.w1.flush()
+        except Exception:
+            pass
+
+    # Drop the results older than the ttl
+    def _expire(self):
+        now = time.time()
+        for key, done in self._results.items():
+            if now - done[0] >= self.ttl:
+                del self._results[key]
+
+    # Run what's already queued, then close the W1ftdi
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put((float("inf"), next(self._seq), None, None, None, None))
+        self._thread.join()
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Instrumentation of the 1-wire operations, see W1ftdi.enable_stats()
+#
+# For each operation (reset, write_bytes, search_roms, get_temp...) we keep
+# a latency histogram, the USB writes/reads and bytes moved, the time spent
+# in USB and sleeping, the largest buffer flushed, and CRC failures. These
+# are kept per operation, and per operation for each ROM. An operation is
+# put down to a ROM when that was the only ROM addressed while it ran.
+#
+# Counts are inclusive, the USB traffic of a write_bytes() inside a get_temp()
+# counts towards both.
+
+import bisect
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket
+# holds anything slower.
+BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+          0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+COUNTERS = ("writes", "reads", "bytes_written", "bytes_read", "usb_seconds",
+            "sleep_seconds", "crc_failures")
+
+# ROMs are kept as strings, "28:01:..."
+def _rom_key(rom):
+    if rom is not None and type(rom) is not str:
+        rom = ":".join("{:02x}".format(b) for b in bytearray(rom))
+    return rom
+
+# The statistics for one operation
+class W1opstats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = [ 0 ] * (len(BOUNDS) + 1)
+        self.counters = dict((key, 0) for key in COUNTERS)
+        self.max_flush = 0
+
+    # Record a run of the operation, which took seconds, and the counters
+    # which changed while it ran.
+    def add(self, seconds, counters, max_flush):
+        self.count += 1
+        self.seconds += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.histogram[bisect.bisect_left(BOUNDS, seconds)] += 1
+        for key, value in counters.items():
+            self.counters[key] += value
+        if max_flush > self.max_flush:
+            self.max_flush = max_flush
+
+    # Estimate the latency percentile (0 to 100) from the histogram, returns
+    # the upper bound of the bucket it falls in.
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if seen >= wanted and count:
+                return BOUNDS[i] if i < len(BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        stats = {
+            "count": self.count,
+            "seconds": self.seconds,
+            "mean": self.seconds / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "histogram": list(self.histogram),
+            "max_flush": self.max_flush,
+        }
+        stats.update(self.counters)
+        return stats
+
+# An operation in progress
+class _Frame(object):
+
+    __slots__ = ("name", "start", "totals", "roms", "max_flush")
+
+    def __init__(self, name, totals, rom):
+        self.name = name
+        self.start = time.time()
+        self.totals = dict(totals)
+        self.roms = set() if rom is None else set((rom,))
+        self.max_flush = 0
+
+class W1stats(object):
+
+    def __init__(self):
+        self.reset()
+
+    # Throw away everything recorded so far
+    def reset(self):
+        self.ops = {}
+        self.roms = {}
+        self.totals = dict((key, 0) for key in COUNTERS)
+        self.max_flush = 0
+        self.crc_roms = {}
+        self._stack = []
+        self._rom = None
+
+    def begin(self, name):
+        self._stack.append(_Frame(name, self.totals, self._rom))
+
+    def end(self):
+        frame = self._stack.pop()
+        seconds = time.time() - frame.start
+        counters = dict((key, self.totals[key] - frame.totals[key]) for key in COUNTERS)
+        if frame.name not in self.ops:
+            self.ops[frame.name] = W1opstats()
+        self.ops[frame.name].add(seconds, counters, frame.max_flush)
+        if len(frame.roms) == 1:
+            ops = self.roms.setdefault(next(iter(frame.roms)), {})
+            if frame.name not in ops:
+                ops[frame.name] = W1opstats()
+            ops[frame.name].add(seconds, counters, frame.max_flush)
+        if self._stack and frame.max_flush > self._stack[-1].max_flush:
+            self._stack[-1].max_flush = frame.max_flush
+
+    # A ROM was addressed, following operations are for that ROM
+    def addressed(self, rom):
+        rom = _rom_key(rom)
+        self._rom = rom
+        if rom is not None:
+            for frame in self._stack:
+                frame.roms.add(rom)
+
+    # The bus was reset, no ROM is addressed
+    def bus_reset(self):
+        self._rom = None
+
+    def usb_write(self, length, seconds):
+        self.totals["writes"] += 1
+        self.totals["bytes_written"] += length
+        self.totals["usb_seconds"] += seconds
+
+    def usb_read(self, length, seconds):
+        self.totals["reads"] += 1
+        self.totals["bytes_read"] += length
+        self.totals["usb_seconds"] += seconds
+
+    def slept(self, seconds):
+        self.totals["sleep_seconds"] += seconds
+
+    def flushed(self, length):
+        if length > self.max_flush:
+            self.max_flush = length
+        if self._stack and length > self._stack[-1].max_flush:
+            self._stack[-1].max_flush = length
+
+    def crc_failure(self, rom=None):
+        self.totals["crc_failures"] += 1
+        rom = _rom_key(rom)
+        if rom is not None:
+            self.crc_roms[rom] = self.crc_roms.get(rom, 0) + 1
+
+    # Everything recorded so far, as plain dictionaries
+    def snapshot(self):
+        return {
+            "totals": dict(self.totals, max_flush=self.max_flush),
+            "ops": dict((name, op.snapshot()) for name, op in self.ops.items()),
+            "roms": dict((rom, dict((name, op.snapshot()) for name, op in ops.items()))
+                         for rom, ops in self.roms.items()),
+            "crc_failures": dict(self.crc_roms),
+        }
+
+    # A table of the operations, one per line
+    def summary(self):
+        lines = [ "{:20} {:>7} {:>10} {:>10} {:>10} {:>7} {:>7} {:>9} {:>9} {:>5}".format(
+                  "op", "count", "mean ms", "p99 ms", "max ms", "writes", "reads", "usb ms", "sleep ms", "crc") ]
+        for name in sorted(self.ops):
+            op = self.ops[name]
+            lines.append("{:20} {:7d} {:10.3f} {:10.3f} {:10.3f} {:7d} {:7d} {:9.3f} {:9.3f} {:5d}".format(
+                name, op.count, op.seconds * 1000.0 / op.count, op.percentile(99) * 1000.0,
+                op.max * 1000.0, op.counters["writes"], op.counters["reads"],
+                op.counters["usb_seconds"] * 1000.0, op.counters["sleep_seconds"] * 1000.0,
+                op.counters["crc_failures"]))
+        return "\n".join(lines)
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# 1-wire over FT232H
+# Debug logging and USB tracing
+#
+# The debug levels 1 to 5 are logged to the "w1ftdi" logger, at the logging
+# levels "DEBUG 1" (19) down to "DEBUG 5" (15), between INFO and DEBUG.
+# Messages are str.format() templates with their arguments, and are only
+# formatted if they're emitted. If logging hasn't been set up, they're
+# printed to stdout as "DEBUG <level> <time>, <message>".
+#
+# W1trace records the raw MPSSE traffic to a binary file. Each record is a
+# little endian double timestamp, a one byte kind (W write, R read, M mark),
+# a 32bit length, and the data.
+
+import logging
+import struct
+import sys
+import time
+
+LEVELS = dict((level, logging.INFO - level) for level in range(1, 6))
+for level, value in LEVELS.items():
+    logging.addLevelName(value, "DEBUG {}".format(level))
+
+logger = logging.getLogger("w1ftdi")
+
+TRACE_MAGIC = "W1TRACE1"
+TRACE_RECORD = struct.Struct("<dcI")
+TRACE_WRITE = "W"
+TRACE_READ = "R"
+TRACE_MARK = "M"
+
+# A debug message, formatted when the logger needs it
+class _Message(object):
+
+    __slots__ = ("msg", "args")
+
+    def __init__(self, msg, args):
+        self.msg = msg
+        self.args = args
+
+    def __str__(self):
+        return self.msg.format(*self.args)
+
+# Log msg at debug level (1 to 5), formatted with args if there are any
+def log(level, msg, args=()):
+    logger.log(LEVELS[min(level, 5)], _Message(msg, args) if args else msg)
+
+# Print the debug messages to stdout, unless the application has set up
+# logging for itself.
+def default_handler():
+    if logger.handlers or logging.getLogger().handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(created).9f, %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(LEVELS[5])
+    logger.propagate = False
+
+# Binary trace of the USB traffic, see W1ftdi.enable_trace()
+class W1trace(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+
+    def record(self, kind, data):
+        self.file.write(TRACE_RECORD.pack(time.time(), kind, len(data)))
+        self.file.write(str(data))
+
+    # Add a note to the trace, eg to mark the start of an operation
+    def mark(self, text):
+        self.record(TRACE_MARK, text)
+
+    def close(self):
+        self.file.close()
+
+# Read back a trace file, yields a tuple of (timestamp, kind, data) for each
+# record.
+def read_trace(path):
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise Exception("Not a W1trace file: {}".format(path))
+        while True:
+            header = f.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size:
+                return
+            timestamp, kind, length = TRACE_RECORD.unpack(header)
+            yield timestamp, kind, bytearray(f.read(length))